@@ -1,24 +1,98 @@
+import io
+import os
 import sys
+import json
+import zlib
 import random
-from flask import Flask, jsonify, request, abort
-from models import db, Category, Question, create_tables
+import click
+from functools import wraps, partial
+from flask import (
+    Flask, Blueprint, current_app, g, jsonify, request, abort,
+    make_response, stream_with_context
+)
+from models import (
+    db, Category, Question, QUESTION_COLUMNS, format_question_row,
+    insert_questions
+)
+from migrations import (
+    create_tables, schema_migrations, question_bank_version, explain
+)
+from search import search_engine, tokenize
+from suggest import suggest_index, DEFAULT_LIMIT, MAX_LIMIT
+from cache import category_cache, data_version
+from importer import (
+    QuestionImporter, read_rows, DEFAULT_BATCH_SIZE, FORMATS
+)
+from pool import pool_stats
+from metrics import request_metrics
+from queries import query_tracker
+from snapshot import question_snapshot
+from warmup import warmup
+from group_commit import group_committer
+from routing import replica_router
+from batch import batch_dispatcher, MAX_BATCH_REQUESTS
+from quiz_token import QuizProgress, next_quiz_token
+from json_provider import fast_json_provider
 from flask_cors import CORS
 from sqlalchemy import func as fn
+from sqlalchemy.exc import IntegrityError
 
 ITEMS_PER_PAGE = 10
+EXPORT_CHUNK_SIZE = 1000
+MAX_BATCH_ITEMS = 1000
+# Ids drawn for a quiz question before picking it by rank, and the
+# resolution of that random rank
+RANDOM_ID_DRAWS = 32
+RANDOM_SCALE = 1 << 30
 
-app = Flask(__name__)
-CORS(app)
+api = Blueprint('api', __name__, cli_group=None)
 
 
-def apply_config_and_setup_db():
-    app.config.from_object('config.DevelopmentConfig')
+# Application factory
+# ---------------------------------------------------------------------
+# Everything a worker needs is loaded here, so that a pre-forking server
+# (gunicorn --preload, uwsgi) loads it once in its master process, see
+# wsgi.py. With setup_db, missing tables are created and migrations are
+# applied, unless SKIP_SCHEMA_CHECK is set, then the connections used
+# for it are closed: connections are only opened after the fork, by the
+# worker that uses them, when it warms up.
+def create_app(config_object='config.DevelopmentConfig', setup_db=True):
+    app = Flask(__name__)
+    app.config.from_object(config_object)
+    if app.config.get('SECRET_KEY_GENERATED', False):
+        app.logger.warning(
+            'SECRET_KEY is not set: quiz tokens are only valid in the '
+            'process that issued them'
+        )
+    app.json = fast_json_provider(app)
+    CORS(app)
+    request_metrics.init_app(app)
+    query_tracker.init_app(app)
+    question_snapshot.init_app(app)
+    group_committer.init_app(app)
+    replica_router.init_app(app)
+    batch_dispatcher.init_app(app)
     db.init_app(app)
+    category_cache.init_app(app)
+    data_version.init_app(app)
+    app.register_blueprint(api)
+
     with app.app_context():
-        create_tables()
+        if setup_db and not app.config.get('SKIP_SCHEMA_CHECK', False):
+            create_tables()
+        engines = list(db.engines.values())
+    for engine in engines:
+        engine.dispose()
+        # a forked worker must not share pooled connections with its
+        # parent: it starts with an empty pool of its own
+        os.register_at_fork(
+            after_in_child=partial(engine.dispose, close=False)
+        )
+    warmup.init_app(app)
+    return app
 
 
-@app.after_request
+@api.after_app_request
 def after_request(response):
     response.headers.add(
         'Access-Control-Allow-Headers',
@@ -40,80 +114,339 @@ def error_response(message, code):
     }), code
 
 
+# Conditional GET
+# ---------------------------------------------------------------
+# The ETag is derived from the version counter of the database, bumped
+# by triggers on every change to the questions or categories, whichever
+# process makes it. It is read before the view runs, so a matching
+# If-None-Match is answered with a 304 after a single-row query. Read
+# from the same database as the view, a replica, the ETag never gets
+# ahead of the data it is sent with. With the question snapshot, it is
+# the version the snapshot was loaded at, without any query.
+def question_bank_etag():
+    snapshot = question_snapshot.get()
+    if snapshot is not None:
+        g.question_bank_version = snapshot.version
+    else:
+        g.question_bank_version = db.session.scalar(
+            db.select(question_bank_version.c.version)
+        )
+    return f'v{g.question_bank_version}'
+
+
+def conditional_get(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        etag = question_bank_etag()
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = current_app.config.get(
+                                            'CACHE_CONTROL', {}
+                                        ).get(view.__name__, 'no-cache')
+        return response
+    return wrapper
+
+
 # Paginator
 # ---------------------------------------------------------------
-def paginator(request, selection):
-    page = request.args.get('page', 1, int)
-    start = (page - 1) * ITEMS_PER_PAGE
-    end = start + ITEMS_PER_PAGE
+def page_arguments(request):
+    return (
+        request.args.get('page', 1, int),
+        request.args.get('after_id', None, int)
+    )
 
-    rows = [i.format() for i in selection]
-    if start > len(selection) - 1:
-        # return the first page if the page number is out of range
-        return rows[0:ITEMS_PER_PAGE], 1
+
+def paginator(request, statement):
+    # Keyset mode (?after_id=<id>) returns the rows following the given
+    # question id, so deep pages cost the same as the first one.
+    # Offset mode (?page=<n>) uses LIMIT/OFFSET in the database.
+    # Rows are plain column tuples: no Question instance is built.
+    page, after_id = page_arguments(request)
+    if after_id is not None:
+        rows = db.session.execute(
+                    statement.where(
+                        Question.id > after_id
+                    ).limit(ITEMS_PER_PAGE + 1)
+               ).all()
+        page = None
     else:
-        return rows[start:end], page
+        rows = []
+        if page > 1:
+            rows = db.session.execute(
+                        statement.offset(
+                            (page - 1) * ITEMS_PER_PAGE
+                        ).limit(ITEMS_PER_PAGE + 1)
+                   ).all()
+        if not rows:
+            # return the first page if the page number is out of range
+            page = 1
+            rows = db.session.execute(
+                        statement.limit(ITEMS_PER_PAGE + 1)
+                   ).all()
+
+    # one extra row is fetched to know whether a next page exists
+    has_next = len(rows) > ITEMS_PER_PAGE
+    rows = rows[:ITEMS_PER_PAGE]
+    next_after_id = rows[-1].id if has_next else None
+
+    return [format_question_row(row) for row in rows], page, next_after_id
+
+
+# Question counts, kept up to date by triggers in the database, so
+# reading them never scans the questions
+# ---------------------------------------------------------------
+def count_questions():
+    return db.session.scalar(
+                db.select(question_bank_version.c.question_count)
+           )
+
+
+def count_questions_by_category():
+    return dict(db.session.execute(
+        db.select(Category.id, Category.question_count)
+    ).all())
+
+
+# Category map {id: type}, read through the category cache
+# ---------------------------------------------------------------
+def load_categories():
+    # from the primary: a map loaded from a lagging replica would be
+    # cached for every request, including those reading their writes
+    return dict(db.session.execute(
+        db.select(Category.id, Category.type),
+        bind_arguments={'bind': db.engine}
+    ).all())
+
+
+def get_category_map():
+    # no older than the version of the ETag of the response
+    return category_cache.get(load_categories,
+                              g.get('question_bank_version'))
 
 
 # List all categories
 # ---------------------------------------------------------------------
-@app.route('/categories', methods=['GET'])
+@api.route('/categories', methods=['GET'])
+@replica_router.read_only
+@conditional_get
 def get_categories():
-    categories = Category.query.all()
     data = {
         'success': True,
-        'categories': {c.id: c.type for c in categories}
+        'categories': get_category_map(),
+        'question_counts': count_questions_by_category(),
+        'total_questions': count_questions(),
     }
     return jsonify(data)
 
 
+# Prometheus metrics
+# ---------------------------------------------------------------------
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    return current_app.response_class(
+        request_metrics.render(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+# Connection pool statistics
+# ---------------------------------------------------------------------
+@api.route('/health/pool', methods=['GET'])
+def get_pool_stats():
+    return jsonify({
+        'success': True,
+        'pool': pool_stats(db.engine),
+    })
+
+
+# Liveness and readiness probes
+# ---------------------------------------------------------------------
+# A worker is live as soon as it serves requests, and ready once it has
+# warmed up (see warmup.py).
+@api.route('/health/live', methods=['GET'])
+def get_liveness():
+    return jsonify({
+        'success': True,
+        'live': True,
+    })
+
+
+@api.route('/health/ready', methods=['GET'])
+def get_readiness():
+    if not warmup.is_ready():
+        return error_response('Warming up', 503)
+    return jsonify({
+        'success': True,
+        'ready': True,
+        'warmup': warmup.stats(),
+    })
+
+
+# Read replica statistics
+# ---------------------------------------------------------------------
+@api.route('/health/replicas', methods=['GET'])
+def get_replica_stats():
+    return jsonify({
+        'success': True,
+        **replica_router.stats(),
+    })
+
+
+# Question snapshot statistics
+# ---------------------------------------------------------------------
+@api.route('/questions/snapshot', methods=['GET'])
+def get_question_snapshot_stats():
+    return jsonify({
+        'success': True,
+        'snapshot': question_snapshot.stats(),
+    })
+
+
+# Category cache statistics
+# ---------------------------------------------------------------------
+@api.route('/categories/cache', methods=['GET'])
+def get_category_cache_stats():
+    return jsonify({
+        'success': True,
+        'cache': category_cache.stats(),
+    })
+
+
 # List questions by category
 # ---------------------------------------------------------------------
-@app.route('/categories/<int:category_id>/questions', methods=['GET'])
+@api.route('/categories/<int:category_id>/questions', methods=['GET'])
+@replica_router.read_only
+@conditional_get
 def get_questions_by_category(category_id):
-    category = db.session.get(Category, category_id)
-    if category is None:
-        abort(404)
-
-    questions = Question.query.order_by(
-                                    Question.id
-                               ).filter(
-                                    Question.category == category.id
-                               ).all()
+    snapshot = question_snapshot.get()
+    if snapshot is not None:
+        category_type = snapshot.categories.get(category_id)
+        if category_type is None:
+            abort(404)
+        question_ids = snapshot.question_ids(category_id)
+        questions_by_page, actual_page, next_after_id = snapshot.page(
+                                                    question_ids,
+                                                    *page_arguments(request),
+                                                    ITEMS_PER_PAGE
+                                                )
+        total_questions = len(question_ids)
+    else:
+        category = db.session.get(Category, category_id)
+        if category is None:
+            abort(404)
+        category_type = category.type
+
+        questions = db.select(*QUESTION_COLUMNS).where(
+                        Question.category == category.id
+                    ).order_by(Question.id)
+        questions_by_page, actual_page, next_after_id = paginator(
+                                                            request,
+                                                            questions
+                                                        )
+        total_questions = category.question_count
 
     data = {
         'success': True,
-        'questions': [q.format() for q in questions],
-        'total_questions': len(questions),
-        'current_category': category.type
+        'questions': questions_by_page,
+        'total_questions': total_questions,
+        'current_category': category_type,
+        'actual_page': actual_page,
+        'next_after_id': next_after_id,
     }
     return jsonify(data)
 
 
 # List questions by page
 # ---------------------------------------------------------------------
-@app.route('/questions', methods=['GET'])
+@api.route('/questions', methods=['GET'])
+@replica_router.read_only
+@conditional_get
 def get_questions_paginated():
-    questions = Question.query.order_by(Question.id).all()
-    questions_by_page, actual_page = paginator(request, questions)
-
-    categories = Category.query.all()
+    snapshot = question_snapshot.get()
+    if snapshot is not None:
+        questions_by_page, actual_page, next_after_id = snapshot.page(
+                                                    snapshot.question_ids(),
+                                                    *page_arguments(request),
+                                                    ITEMS_PER_PAGE
+                                                )
+        total_questions = len(snapshot.ids)
+        categories = snapshot.categories
+    else:
+        questions = db.select(*QUESTION_COLUMNS).order_by(Question.id)
+        questions_by_page, actual_page, next_after_id = paginator(
+                                                            request,
+                                                            questions
+                                                        )
+        total_questions = count_questions()
+        categories = get_category_map()
 
     data = {
         'success': True,
         'questions': questions_by_page,
-        'total_questions': len(questions),
-        'categories': {c.id: c.type for c in categories},
+        'total_questions': total_questions,
+        'categories': categories,
         'current_category': '',
         'actual_page': actual_page,
+        'next_after_id': next_after_id,
     }
 
     return jsonify(data)
 
 
+# Export questions as NDJSON
+# ---------------------------------------------------------------------
+@api.route('/questions/export', methods=['GET'])
+@replica_router.read_only
+def export_questions():
+    criteria = []
+    category_id = request.args.get('category', None, int)
+    if category_id is not None:
+        if db.session.get(Category, category_id) is None:
+            abort(404)
+        criteria.append(Question.category == category_id)
+    compress = request.args.get('gzip', 'false').lower() in ('1', 'true')
+
+    # Rows are fetched through a server-side cursor in chunks, and
+    # written out as they arrive, so memory use doesn't depend on the
+    # size of the question bank.
+    def generate():
+        rows = db.session.execute(
+                    db.select(*QUESTION_COLUMNS).where(
+                        *criteria
+                    ).order_by(Question.id)
+                    .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+               )
+        for chunk in rows.partitions():
+            yield ''.join(
+                json.dumps(row._asdict()) + '\n' for row in chunk
+            ).encode()
+
+    def generate_gzip():
+        compressor = zlib.compressobj(wbits=31)
+        for chunk in generate():
+            yield compressor.compress(chunk)
+        yield compressor.flush()
+
+    response = current_app.response_class(
+                    stream_with_context(
+                        generate_gzip() if compress else generate()
+                    ),
+                    mimetype='application/x-ndjson'
+               )
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
 # Delete a specific question
 # ---------------------------------------------------------------------
-@app.route('/questions/<int:question_id>', methods=['DELETE'])
+@api.route('/questions/<int:question_id>', methods=['DELETE'])
 def delete_question(question_id):
     error = False
     question = db.session.get(Question, question_id)
@@ -122,6 +455,9 @@ def delete_question(question_id):
 
     try:
         question.delete()
+        data_version.bump()
+        search_engine.discard(question_id)
+        suggest_index.discard(question_id)
     except Exception:
         error = True
         db.session.rollback()
@@ -143,7 +479,10 @@ def delete_question(question_id):
 # Validate question data from request body
 # ---------------------------------------------------------------------
 def validate_question_data(request):
-    body = request.get_json()
+    return validate_question_fields(request.get_json())
+
+
+def validate_question_fields(body):
     # print(body)
     question = body.get('question', None)
     answer = body.get('answer', None)
@@ -157,7 +496,7 @@ def validate_question_data(request):
     try:
         difficulty = int(difficulty)
         category = int(category)
-    except ValueError:
+    except (TypeError, ValueError):
         return None
 
     return {
@@ -170,7 +509,7 @@ def validate_question_data(request):
 
 # POST /questions endpoint
 # ---------------------------------------------------------------------
-@app.route('/questions', methods=['POST'])
+@api.route('/questions', methods=['POST'])
 def dispatch_post_questions():
     if 'search_term' in request.get_json():
         return search_questions(request)
@@ -194,10 +533,20 @@ def add_question(request):
         return error_response('Category not found', 404)
 
     try:
-        question = Question()
-        question.populate_from_dict(question_data)
-        question.insert()
-        question_id = question.id
+        if group_committer.enabled():
+            # the connection of the request isn't held while waiting
+            db.session.close()
+            question_id = group_committer.submit(question_data)
+        else:
+            question = Question()
+            question.populate_from_dict(question_data)
+            question.insert()
+            question_id = question.id
+        data_version.bump()
+        search_engine.add(
+            question_id, question_data['question'], question_data['answer']
+        )
+        suggest_index.add(question_id, question_data['question'])
     except Exception:
         error = True
         db.session.rollback()
@@ -217,30 +566,441 @@ def add_question(request):
         })
 
 
+# Bulk import of questions
+# ---------------------------------------------------------------------
+def import_questions(stream, format, batch_size):
+    importer = QuestionImporter(
+                    validate_question_fields,
+                    [c.id for c in Category.query.all()],
+                    batch_size
+               )
+    report = importer.run(read_rows(stream, format))
+
+    if report['imported']:
+        data_version.bump()
+        search_engine.reset()
+        suggest_index.reset()
+    return report
+
+
+@api.route('/questions/bulk', methods=['POST'])
+def bulk_import_questions():
+    format = request.args.get('format', None)
+    if format is None:
+        format = 'csv' if request.mimetype == 'text/csv' else 'jsonl'
+    batch_size = request.args.get('batch_size', DEFAULT_BATCH_SIZE, int)
+    if format not in FORMATS or batch_size < 1:
+        abort(400)
+
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    report = import_questions(stream, format, batch_size)
+    db.session.close()
+
+    return jsonify({
+        'success': True,
+        **report,
+    })
+
+
+@api.cli.command('import-questions')
+@click.argument('file', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', type=click.Choice(FORMATS), default=None,
+              help='File format, guessed from the file extension.')
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+def import_questions_command(file, format, batch_size):
+    """Import questions from a JSONL or CSV file."""
+    if format is None:
+        format = 'csv' if file.lower().endswith('.csv') else 'jsonl'
+    with open(file, encoding='utf-8', newline='') as stream:
+        report = import_questions(stream, format, batch_size)
+
+    for batch in report['errors']:
+        for error in batch['errors']:
+            click.echo(
+                f"batch {batch['batch']}, line {error['line']}: "
+                f"{error['message']}",
+                err=True
+            )
+    click.echo(
+        f"{report['imported']} questions imported, "
+        f"{report['rejected']} rejected in {report['seconds']}s "
+        f"({report['rows_per_second']} rows/s)"
+    )
+
+
+# Schema maintenance
+# ---------------------------------------------------------------------
+@api.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations and list the applied ones."""
+    create_tables()
+    migrations = db.session.execute(
+                    db.select(schema_migrations).order_by(
+                        schema_migrations.c.version
+                    )
+                 ).all()
+    for migration in migrations:
+        click.echo(
+            f'{migration.version:>4}  {migration.applied_at:%Y-%m-%d %H:%M}'
+            f'  {migration.description}'
+        )
+
+
+# Hot queries: (name, statement, indexes that can serve it)
+def hot_queries():
+    in_category = Question.category == 1
+    by_category = ('ix_questions_category_id', 'ix_questions_category')
+    return [
+        (
+            'questions of a category',
+            db.select(Question).where(in_category).order_by(
+                Question.id
+            ).limit(ITEMS_PER_PAGE + 1),
+            by_category
+        ),
+        (
+            'question count of a category',
+            db.select(fn.count(Question.id)).where(in_category),
+            by_category
+        ),
+        (
+            'quiz question id range of a category',
+            question_id_range_statement([in_category]),
+            by_category
+        ),
+        (
+            'drawn quiz questions of a category',
+            drawn_questions_statement([in_category], [1, 2, 3]),
+            ('questions_pkey', 'INTEGER PRIMARY KEY')
+        ),
+        (
+            'quiz question of a category',
+            random_question_statement([in_category], []),
+            by_category
+        ),
+        (
+            'category by name',
+            db.select(Category).where(
+                fn.lower(Category.type) == fn.lower('Science')
+            ),
+            ('ix_categories_type_lower',)
+        ),
+    ]
+
+
+def check_query_plans():
+    results = []
+    with db.engine.connect() as connection:
+        for name, statement, indexes in hot_queries():
+            plan = explain(connection, statement)
+            results.append({
+                'query': name,
+                'index': next((i for i in indexes if i in plan), None),
+                'plan': plan,
+            })
+        connection.rollback()
+    return results
+
+
+@api.cli.command('check-indexes')
+@click.option('--verbose', is_flag=True, help='Print the query plans.')
+def check_indexes_command(verbose):
+    """EXPLAIN the hot queries and check that they use an index."""
+    results = check_query_plans()
+    for result in results:
+        click.echo(
+            f"{'ok' if result['index'] else 'NO INDEX':<8}  "
+            f"{result['query']}" +
+            (f" ({result['index']})" if result['index'] else '')
+        )
+        if verbose or not result['index']:
+            click.echo(result['plan'])
+    if not all(result['index'] for result in results):
+        sys.exit(1)
+
+
+# Batch writes of questions
+# ---------------------------------------------------------------------
+# Each batch is written with a single statement in a single transaction
+# and every item gets its own result, in the order of the request.
+def item_error(message, code):
+    return {
+        'success': False,
+        'error': code,
+        'message': message
+    }
+
+
+def is_question_id(item):
+    return isinstance(item, int) and not isinstance(item, bool)
+
+
+def get_batch_items(key):
+    items = request.get_json().get(key, None)
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_BATCH_ITEMS:
+        abort(400)
+    return items
+
+
+@api.route('/questions/batch', methods=['POST'])
+def batch_add_questions():
+    items = get_batch_items('questions')
+
+    results = []
+    valid = []
+    for item in items:
+        data = validate_question_fields(item) \
+            if isinstance(item, dict) else None
+        results.append(data)
+        if data is not None:
+            valid.append(data)
+
+    categories = {
+        c.id
+        for c in Category.query.filter(
+                    Category.id.in_({d['category'] for d in valid})
+                 ).all()
+    }
+    valid = [d for d in valid if d['category'] in categories]
+
+    error = False
+    question_ids = []
+    if valid:
+        try:
+            question_ids = insert_questions(db.session, valid)
+            db.session.commit()
+        except Exception:
+            error = True
+            db.session.rollback()
+            print(sys.exc_info())
+        finally:
+            db.session.close()
+
+    if question_ids:
+        data_version.bump()
+        for question_id, data in zip(question_ids, valid):
+            search_engine.add(question_id, data['question'], data['answer'])
+            suggest_index.add(question_id, data['question'])
+
+    question_ids = iter(question_ids)
+    for i, data in enumerate(results):
+        if data is None:
+            results[i] = item_error('Invalid question data', 400)
+        elif data['category'] not in categories:
+            results[i] = item_error('Category not found', 404)
+        elif error:
+            results[i] = item_error(
+                'Server error. Question could not be created.', 500
+            )
+        else:
+            results[i] = {
+                'success': True,
+                'question_id': next(question_ids),
+            }
+
+    return jsonify({
+        'success': not error,
+        'results': results,
+    }), 500 if error else 200
+
+
+@api.route('/questions/batch-delete', methods=['POST'])
+def batch_delete_questions():
+    items = get_batch_items('ids')
+
+    question_ids = {item for item in items if is_question_id(item)}
+
+    error = False
+    deleted = set()
+    if question_ids:
+        try:
+            deleted = set(db.session.execute(
+                db.delete(Question).where(
+                    Question.id.in_(question_ids)
+                ).returning(Question.id)
+            ).scalars())
+            db.session.commit()
+        except Exception:
+            error = True
+            db.session.rollback()
+            print(sys.exc_info())
+        finally:
+            db.session.close()
+
+    if deleted:
+        data_version.bump()
+        for question_id in deleted:
+            search_engine.discard(question_id)
+            suggest_index.discard(question_id)
+
+    results = []
+    for item in items:
+        if not is_question_id(item):
+            results.append(item_error('Invalid question id', 400))
+        elif error:
+            results.append(item_error(
+                f'Server error. Question id:{item} could not be deleted.',
+                500
+            ))
+        elif item not in deleted:
+            results.append(item_error('Not found', 404))
+        else:
+            results.append({
+                'success': True,
+                'question_id': item,
+            })
+
+    return jsonify({
+        'success': not error,
+        'results': results,
+    }), 500 if error else 200
+
+
+# Multi-call batch
+# ---------------------------------------------------------------------
+# Sub-requests are dispatched in-process to the views (see batch.py) and
+# their responses are returned in the order of the request. The JSON
+# bodies of the responses are embedded as they are, without being
+# decoded and encoded again.
+def validate_batch_call(item):
+    if not isinstance(item, dict):
+        return None
+    method = item.get('method', 'GET')
+    path = item.get('path', None)
+    if (method not in ('GET', 'POST', 'PATCH', 'DELETE')
+            or not isinstance(path, str) or not path.startswith('/')):
+        return None
+    return method, path, item.get('body', None)
+
+
+@api.route('/batch', methods=['POST'])
+def dispatch_batch():
+    replica_router.not_a_write()
+    items = request.get_json().get('requests', None)
+    if (not isinstance(items, list)
+            or not 0 < len(items) <= MAX_BATCH_REQUESTS):
+        abort(400)
+
+    calls = []
+    errors = {}
+    for i, item in enumerate(items):
+        call = validate_batch_call(item)
+        if call is None:
+            errors[i] = item_error('Invalid request', 400)
+        else:
+            calls.append(call)
+
+    responses = iter(batch_dispatcher.dispatch(calls, request.cookies))
+    parts = []
+    cookies = []
+    for i in range(len(items)):
+        if i in errors:
+            status = 400
+            data = current_app.json.dumps(errors[i]).encode('utf-8')
+        else:
+            status, data, set_cookies = next(responses)
+            cookies.extend(set_cookies)
+        parts.append(b'{"body":%s,"status":%d}' % (data, status))
+
+    response = current_app.response_class(
+        b'{"responses":[%s],"success":true}' % b','.join(parts),
+        mimetype='application/json'
+    )
+    for cookie in cookies:
+        response.headers.add('Set-Cookie', cookie)
+    return response
+
+
 # Search questions
 # ---------------------------------------------------------------------
 def search_questions(request):
-    search_term = request.get_json()['search_term']
-
-    questions = Question.query.filter(
-                    Question.question.ilike(f'%{search_term}%')
-                ).all()
+    replica_router.use_replica()
+    body = request.get_json()
+    search_term = body['search_term']
+    try:
+        page = int(body.get('page', 1))
+    except (TypeError, ValueError):
+        abort(400)
+    # pages below the first one are the first page, as in paginator
+    page = max(page, 1)
+
+    # Matching questions are ranked by relevance inside the search engine
+    question_ids, total = search_engine.match(
+                            search_term,
+                            (page - 1) * ITEMS_PER_PAGE,
+                            ITEMS_PER_PAGE
+                          )
+    if not question_ids and page != 1:
+        # return the first page if the page number is out of range
+        page = 1
+        question_ids, total = search_engine.match(
+                                search_term, 0, ITEMS_PER_PAGE
+                              )
+
+    questions = {
+        row.id: row
+        for row in db.session.execute(
+                    db.select(*QUESTION_COLUMNS).where(
+                        Question.id.in_(question_ids)
+                    )
+                   )
+    }
 
     data = {
         'success': True,
-        'questions': [q.format() for q in questions],
-        'total_questions': len(questions),
-        'current_category': ''
+        'questions': [
+            format_question_row(questions[i])
+            for i in question_ids if i in questions
+        ],
+        'total_questions': total,
+        'current_category': '',
+        'actual_page': page,
     }
 
     return jsonify(data)
 
 
+# Suggest search terms
+# ---------------------------------------------------------------------
+# The last word of the query is completed from the words of the question
+# texts, e.g. 'who disc' gives 'who discovered', without any query once
+# the prefix index is built, but for the check of the version counter
+# of the database every SUGGEST_INDEX_POLL seconds.
+@api.route('/questions/suggest', methods=['GET'])
+def suggest_search_terms():
+    query = request.args.get('q', '')
+    try:
+        limit = int(request.args.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        abort(400)
+    if not 1 <= limit <= MAX_LIMIT:
+        abort(400)
+
+    suggestions = []
+    tokens = tokenize(query)
+    if tokens and not query[-1].isspace():
+        suggest_index.refresh()
+        *words, prefix = tokens
+        suggestions = [
+            {
+                'term': ' '.join(words + [token]),
+                'questions': count,
+            }
+            for token, count in suggest_index.complete(prefix, limit)
+        ]
+
+    return jsonify({
+        'success': True,
+        'suggestions': suggestions,
+    })
+
+
 # Add a new category
 # ---------------------------------------------------------------------
-@app.route('/categories', methods=['POST'])
+@api.route('/categories', methods=['POST'])
 def add_category():
     error = False
+    duplicate = False
     category_type = request.get_json().get('category', None)
     if not category_type:
         abort(400)
@@ -258,6 +1018,12 @@ def add_category():
         category = Category(category_type)
         category.insert()
         category_id = category.id
+        data_version.bump()
+        category_cache.invalidate()
+    except IntegrityError:
+        # created by a concurrent request since the check above
+        duplicate = True
+        db.session.rollback()
     except Exception:
         error = True
         db.session.rollback()
@@ -265,7 +1031,12 @@ def add_category():
     finally:
         db.session.close()
 
-    if error:
+    if duplicate:
+        return error_response(
+                f"Category '{category_type}' already exists.",
+                400
+              )
+    elif error:
         return error_response(
             'Server error. New category could not be created.',
             500
@@ -279,7 +1050,7 @@ def add_category():
 
 # Delete a specific category
 # ---------------------------------------------------------------------
-@app.route('/categories/<int:category_id>', methods=['DELETE'])
+@api.route('/categories/<int:category_id>', methods=['DELETE'])
 def delete_category(category_id):
     error = False
     category = db.session.get(Category, category_id)
@@ -288,6 +1059,11 @@ def delete_category(category_id):
 
     try:
         category.delete()
+        data_version.bump()
+        category_cache.invalidate()
+        # questions of the category are deleted along with it
+        search_engine.reset()
+        suggest_index.reset()
     except Exception:
         error = True
         db.session.rollback()
@@ -309,7 +1085,12 @@ def delete_category(category_id):
 # Validate quiz data
 # ---------------------------------------------------------------------
 def validate_quiz_data(request):
-    data = request.get_json()
+    return validate_quiz_fields(request.get_json(), current_app.secret_key)
+
+
+# The questions already asked are read from the quiz_token of a
+# previous response, or from the previous_questions list
+def validate_quiz_fields(data, secret_key=None):
     # print(data)
 
     category = data.get('quiz_category', None)
@@ -318,6 +1099,20 @@ def validate_quiz_data(request):
     else:
         category_id = None
 
+    # A token that doesn't verify, e.g. signed by a worker with its own
+    # random key, falls back to the list of previous questions if any
+    quiz_token = data.get('quiz_token', None)
+    if quiz_token is not None and category_id is not None:
+        try:
+            category_id = int(category_id)
+            progress = QuizProgress.loads(quiz_token, secret_key,
+                                          category_id)
+        except (TypeError, ValueError):
+            if 'previous_questions' not in data:
+                return False, None, None
+        else:
+            return True, category_id, progress
+
     previous_questions = data.get('previous_questions', None)
 
     if previous_questions is None or category_id is None:
@@ -327,64 +1122,166 @@ def validate_quiz_data(request):
     try:
         category_id = int(category_id)
         previous_questions_int = [int(q) for q in previous_questions]
-    except ValueError:
+    except (TypeError, ValueError):
         return False, None, None
 
     return True, category_id, previous_questions_int
 
 
+# Pick a random question inside the database
+# ---------------------------------------------------------------------
+# Ids are drawn uniformly between the lowest and the highest id of the
+# pool, and the first drawn id of an eligible question is taken: every
+# eligible question has the same chance to be picked, and the cost is
+# that of RANDOM_ID_DRAWS lookups by id whatever the size of the pool.
+# Ids of asked questions are left out before the query, so it never
+# lists them. When no draw hits an eligible question (a sparse pool, or
+# most of it asked already), the question is picked by rank instead.
+def select_random_question(pool, previous_questions):
+    low, high = db.session.execute(question_id_range_statement(pool)).one()
+    if low is None:
+        return None
+    ids = draw_question_ids(low, high, previous_questions)
+    if ids:
+        question = first_drawn_question(
+                        db.session.execute(
+                            drawn_questions_statement(pool, ids)
+                        ).scalars(),
+                        ids
+                   )
+        if question is not None:
+            return question
+    return db.session.execute(
+                random_question_statement(pool, set(previous_questions))
+           ).scalar_one_or_none()
+
+
+def question_id_range_statement(pool):
+    # two scalar subqueries: each one reads one end of the index
+    return db.select(
+        db.select(fn.min(Question.id)).where(*pool).scalar_subquery(),
+        db.select(fn.max(Question.id)).where(*pool).scalar_subquery()
+    )
+
+
+def draw_question_ids(low, high, previous_questions):
+    ids = []
+    for _ in range(RANDOM_ID_DRAWS):
+        id = random.randint(low, high)
+        if id not in previous_questions and id not in ids:
+            ids.append(id)
+    return ids
+
+
+def drawn_questions_statement(pool, ids):
+    return db.select(Question).where(*pool, Question.id.in_(ids))
+
+
+def first_drawn_question(questions, ids):
+    questions = {question.id: question for question in questions}
+    return next((questions[id] for id in ids if id in questions), None)
+
+
+def random_question_statement(pool, previous_questions):
+    # The eligible questions are counted and the one at a uniformly
+    # random rank is taken, with OFFSET count * r // RANDOM_SCALE for r
+    # drawn in [0, RANDOM_SCALE). Counting and skipping are range scans
+    # of the (category, id) index, sent in a single statement, so that
+    # every eligible question has the same chance to be picked.
+    eligible = list(pool)
+    if previous_questions:
+        eligible.append(Question.id.not_in(previous_questions))
+
+    count = db.select(fn.count(Question.id)).where(
+                *eligible
+            ).scalar_subquery()
+    rank = count * random.randrange(RANDOM_SCALE) // RANDOM_SCALE
+
+    return db.select(Question).where(
+                *eligible
+           ).order_by(Question.id).offset(rank).limit(1)
+
+
 # Get the next question
 # ---------------------------------------------------------------------
-@app.route('/quizzes', methods=['POST'])
+@api.route('/quizzes', methods=['POST'])
+@replica_router.read_only
 def get_next_question():
     result, category_id, previous_questions = validate_quiz_data(request)
     if not result:
         abort(400)
     # print(category_id, previous_questions)
 
-    if category_id == 0:
-        all_question_ids = [
-            q.id
-            for q in Question.query.all()
-        ]
-    else:
+    snapshot = question_snapshot.get()
+    if snapshot is not None:
+        return next_question_from_snapshot(
+                    snapshot,
+                    category_id,
+                    previous_questions
+               )
+
+    pool = []
+    if category_id != 0:
         category = Category.query.filter(
                    Category.id == category_id
                   ).one_or_none()
         if category is None:
             return error_response('Category not found', 404)
+        pool.append(Question.category == category_id)
 
-        all_question_ids = [
-            q.id
-            for q in Question.query.filter(
-                    Question.category == category_id
-                 ).all()
-        ]
-    # print(all_question_ids)
+    # Previous questions must all belong to the current pool, unless
+    # they come from a quiz token, checked when it was issued
+    if not isinstance(previous_questions, QuizProgress):
+        previous_questions = set(previous_questions)
+        if previous_questions:
+            found = Question.query.filter(
+                        *pool,
+                        Question.id.in_(previous_questions)
+                    ).count()
+            if found != len(previous_questions):
+                return error_response('Invalid previous questions', 400)
 
-    if not set(previous_questions).issubset(all_question_ids):
-        return error_response('Invalid previous questions', 400)
+    question = select_random_question(pool, previous_questions)
+    if question is not None:
+        question = question.format()
 
-    next_question_pool = set(all_question_ids).difference(previous_questions)
-    # print(next_question_pool)
+    return quiz_response(category_id, previous_questions, question)
+
+
+def next_question_from_snapshot(snapshot, category_id, previous_questions):
+    if category_id != 0 and category_id not in snapshot.categories:
+        return error_response('Category not found', 404)
+    question_ids = snapshot.question_ids(category_id or None)
+
+    if not isinstance(previous_questions, QuizProgress):
+        previous_questions = set(previous_questions)
+        if not all(snapshot.contains(question_ids, id)
+                   for id in previous_questions):
+            return error_response('Invalid previous questions', 400)
+
+    return quiz_response(
+                category_id,
+                previous_questions,
+                snapshot.random_question(question_ids, previous_questions)
+           )
 
-    if len(next_question_pool) != 0:
-        question_id = random.choice(list(next_question_pool))
-        question = Question.query.filter(
-                        Question.id == question_id
-                   ).one().format()
-    else:
-        question = None
 
+def quiz_response(category_id, previous_questions, question):
     return jsonify({
         'success': True,
         'question': question,
+        'quiz_token': next_quiz_token(
+                        category_id,
+                        previous_questions,
+                        question['id'] if question is not None else None,
+                        current_app.secret_key
+                      ),
     })
 
 
 # Default error handlers
 # ---------------------------------------------------------------------
-@app.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found(error):
     return jsonify({
         'success': False,
@@ -393,7 +1290,7 @@ def not_found(error):
     }), 404
 
 
-@app.errorhandler(400)
+@api.app_errorhandler(400)
 def bad_request(error):
     return jsonify({
         'success': False,
@@ -402,7 +1299,7 @@ def bad_request(error):
     }), 400
 
 
-@app.errorhandler(500)
+@api.app_errorhandler(500)
 def server_error(error):
     return jsonify({
         'success': False,
@@ -411,7 +1308,7 @@ def server_error(error):
     }), 500
 
 
-@app.errorhandler(422)
+@api.app_errorhandler(422)
 def unprocessable_entity(error):
     return jsonify({
         'success': False,
@@ -421,5 +1318,4 @@ def unprocessable_entity(error):
 
 
 if __name__ == '__main__':
-    apply_config_and_setup_db()
-    app.run()
+    create_app().run()
@@ -0,0 +1,608 @@
+import sys
+import json
+from functools import wraps
+from importlib import import_module
+from sqlalchemy import func as fn
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response
+from starlette.routing import Route
+from werkzeug.http import parse_etags, quote_etag
+from models import (
+    db, Category, Question, QUESTION_COLUMNS, format_question_row
+)
+from search import search_engine
+from cache import category_cache, data_version
+from json_provider import fast_dumps
+from migrations import question_bank_version
+from quiz_token import QuizProgress, next_quiz_token
+from app import (
+    ITEMS_PER_PAGE,
+    validate_question_fields,
+    validate_quiz_fields,
+    question_id_range_statement,
+    draw_question_ids,
+    drawn_questions_statement,
+    first_drawn_question,
+    random_question_statement,
+)
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+ERROR_MESSAGES = {
+    400: 'Invalid request',
+    404: 'Not found',
+    405: 'Method not allowed',
+    422: 'Unprocessable entity',
+    500: 'Internal server error',
+}
+
+
+# Async ASGI entry point
+# ---------------------------------------------------------------------
+# Serves the routes of the Trivia API from app.py with the same JSON
+# contracts, on top of an async SQLAlchemy engine, so that a single
+# process keeps many requests in flight while they wait for the
+# database. Run it with an ASGI server, e.g.:
+#
+#   uvicorn --factory asgi:create_asgi_app --workers 4
+#
+# The bulk, export, batch and statistics endpoints are only served by
+# the WSGI app.
+
+
+# JSON responses, encoded the same way as Flask's jsonify
+# ---------------------------------------------------------------------
+def jsonify(data, status_code=200):
+    return Response(
+        (fast_dumps(data) or json.dumps(
+            data, sort_keys=True, separators=(',', ':')
+        )) + '\n',
+        status_code=status_code,
+        media_type='application/json',
+        headers={
+            'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+            'Access-Control-Allow-Methods':
+                'GET, POST, PATCH, DELETE, OPTIONS',
+        }
+    )
+
+
+def error_response(message, code):
+    return jsonify({
+        'success': False,
+        'error': code,
+        'message': message
+    }, code)
+
+
+def abort(code):
+    raise HTTPException(status_code=code)
+
+
+async def http_error(request, exc):
+    return error_response(
+        ERROR_MESSAGES.get(exc.status_code, exc.detail), exc.status_code
+    )
+
+
+async def server_error(request, exc):
+    print(sys.exc_info())
+    return error_response(ERROR_MESSAGES[500], 500)
+
+
+async def get_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        abort(400)
+
+
+def get_int_arg(request, name, default):
+    try:
+        return int(request.query_params[name])
+    except (KeyError, ValueError):
+        return default
+
+
+# Conditional GET, see conditional_get() in app.py
+# ---------------------------------------------------------------------
+def conditional_get(endpoint):
+    @wraps(endpoint)
+    async def wrapper(request):
+        async with request.app.state.sessions() as session:
+            request.state.question_bank_version = await session.scalar(
+                db.select(question_bank_version.c.version)
+            )
+        etag = f'v{request.state.question_bank_version}'
+        if_none_match = parse_etags(request.headers.get('If-None-Match'))
+        if if_none_match.contains(etag):
+            response = Response(status_code=304)
+        else:
+            response = await endpoint(request)
+            if response.status_code != 200:
+                return response
+
+        response.headers['ETag'] = quote_etag(etag)
+        response.headers['Cache-Control'] = request.app.state.config.get(
+                                                'CACHE_CONTROL', {}
+                                            ).get(endpoint.__name__,
+                                                  'no-cache')
+        return response
+    return wrapper
+
+
+# Paginator, see paginator() in app.py
+# ---------------------------------------------------------------------
+async def paginator(session, request, statement):
+    after_id = get_int_arg(request, 'after_id', None)
+    if after_id is not None:
+        rows = (await session.execute(
+                    statement.where(
+                        Question.id > after_id
+                    ).limit(ITEMS_PER_PAGE + 1)
+               )).all()
+        page = None
+    else:
+        page = get_int_arg(request, 'page', 1)
+        rows = []
+        if page > 1:
+            rows = (await session.execute(
+                        statement.offset(
+                            (page - 1) * ITEMS_PER_PAGE
+                        ).limit(ITEMS_PER_PAGE + 1)
+                   )).all()
+        if not rows:
+            # return the first page if the page number is out of range
+            page = 1
+            rows = (await session.execute(
+                        statement.limit(ITEMS_PER_PAGE + 1)
+                   )).all()
+
+    # one extra row is fetched to know whether a next page exists
+    has_next = len(rows) > ITEMS_PER_PAGE
+    rows = rows[:ITEMS_PER_PAGE]
+    next_after_id = rows[-1].id if has_next else None
+
+    return [format_question_row(row) for row in rows], page, next_after_id
+
+
+async def count_questions(session, *criteria):
+    return await session.scalar(
+                db.select(fn.count(Question.id)).where(*criteria)
+           )
+
+
+# Question counts kept by triggers, see count_questions() in app.py
+async def count_all_questions(session):
+    return await session.scalar(
+                db.select(question_bank_version.c.question_count)
+           )
+
+
+async def count_questions_by_category(session):
+    return dict((await session.execute(
+        db.select(Category.id, Category.question_count)
+    )).all())
+
+
+async def get_category_map(session, version):
+    categories, ticket = category_cache.lookup(version)
+    if ticket is not None:
+        categories = {
+            c.id: c.type
+            for c in (await session.execute(
+                        db.select(Category)
+                     )).scalars()
+        }
+        category_cache.store(categories, ticket)
+    return categories
+
+
+# List all categories
+# ---------------------------------------------------------------------
+@conditional_get
+async def get_categories(request):
+    async with request.app.state.sessions() as session:
+        categories = await get_category_map(
+            session, request.state.question_bank_version
+        )
+        question_counts = await count_questions_by_category(session)
+        total_questions = await count_all_questions(session)
+
+    return jsonify({
+        'success': True,
+        'categories': categories,
+        'question_counts': question_counts,
+        'total_questions': total_questions,
+    })
+
+
+# List questions by category
+# ---------------------------------------------------------------------
+@conditional_get
+async def get_questions_by_category(request):
+    category_id = request.path_params['category_id']
+    async with request.app.state.sessions() as session:
+        category = await session.get(Category, category_id)
+        if category is None:
+            abort(404)
+
+        criteria = Question.category == category.id
+        questions_by_page, actual_page, next_after_id = await paginator(
+            session,
+            request,
+            db.select(*QUESTION_COLUMNS).where(criteria).order_by(
+                Question.id
+            )
+        )
+        total_questions = category.question_count
+
+    return jsonify({
+        'success': True,
+        'questions': questions_by_page,
+        'total_questions': total_questions,
+        'current_category': category.type,
+        'actual_page': actual_page,
+        'next_after_id': next_after_id,
+    })
+
+
+# List questions by page
+# ---------------------------------------------------------------------
+@conditional_get
+async def get_questions_paginated(request):
+    async with request.app.state.sessions() as session:
+        questions_by_page, actual_page, next_after_id = await paginator(
+            session,
+            request,
+            db.select(*QUESTION_COLUMNS).order_by(Question.id)
+        )
+        total_questions = await count_all_questions(session)
+        categories = await get_category_map(
+            session, request.state.question_bank_version
+        )
+
+    return jsonify({
+        'success': True,
+        'questions': questions_by_page,
+        'total_questions': total_questions,
+        'categories': categories,
+        'current_category': '',
+        'actual_page': actual_page,
+        'next_after_id': next_after_id,
+    })
+
+
+# Delete a specific question
+# ---------------------------------------------------------------------
+async def delete_question(request):
+    question_id = request.path_params['question_id']
+    async with request.app.state.sessions() as session:
+        question = await session.get(Question, question_id)
+        if question is None:
+            abort(404)
+
+        try:
+            await session.delete(question)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            print(sys.exc_info())
+            return error_response(
+                f'Server error. Question id:{question_id} '
+                'could not be deleted.',
+                500
+            )
+
+    data_version.bump()
+    search_engine.discard(question_id)
+    return jsonify({
+        'success': True,
+    })
+
+
+# POST /questions endpoint
+# ---------------------------------------------------------------------
+async def dispatch_post_questions(request):
+    body = await get_json(request)
+    if 'search_term' in body:
+        return await search_questions(request, body)
+    else:
+        return await add_question(request, body)
+
+
+# Add a new question
+# ---------------------------------------------------------------------
+async def add_question(request, body):
+    question_data = validate_question_fields(body)
+    if question_data is None:
+        abort(400)
+
+    async with request.app.state.sessions() as session:
+        category = await session.get(Category, question_data['category'])
+        if category is None:
+            return error_response('Category not found', 404)
+
+        try:
+            question = Question()
+            question.populate_from_dict(question_data)
+            session.add(question)
+            await session.commit()
+            question_id = question.id
+        except Exception:
+            await session.rollback()
+            print(sys.exc_info())
+            return error_response(
+                'Server error. New question could not be created.',
+                500
+            )
+
+    data_version.bump()
+    search_engine.add(
+        question_id, question_data['question'], question_data['answer']
+    )
+    return jsonify({
+        'success': True,
+        'question_id': question_id,
+    })
+
+
+# Search questions
+# ---------------------------------------------------------------------
+async def search_questions(request, body):
+    search_term = body['search_term']
+    try:
+        page = int(body.get('page', 1))
+    except (TypeError, ValueError):
+        abort(400)
+    # pages below the first one are the first page, as in paginator
+    page = max(page, 1)
+
+    async with request.app.state.sessions() as session:
+        question_ids, total = await search_engine.match_async(
+                                session,
+                                search_term,
+                                (page - 1) * ITEMS_PER_PAGE,
+                                ITEMS_PER_PAGE
+                              )
+        if not question_ids and page != 1:
+            # return the first page if the page number is out of range
+            page = 1
+            question_ids, total = await search_engine.match_async(
+                                    session, search_term, 0, ITEMS_PER_PAGE
+                                  )
+
+        questions = {
+            row.id: row
+            for row in await session.execute(
+                        db.select(*QUESTION_COLUMNS).where(
+                            Question.id.in_(question_ids)
+                        )
+                       )
+        }
+
+    return jsonify({
+        'success': True,
+        'questions': [
+            format_question_row(questions[i])
+            for i in question_ids if i in questions
+        ],
+        'total_questions': total,
+        'current_category': '',
+        'actual_page': page,
+    })
+
+
+# Add a new category
+# ---------------------------------------------------------------------
+async def add_category(request):
+    category_type = (await get_json(request)).get('category', None)
+    if not category_type:
+        abort(400)
+
+    async with request.app.state.sessions() as session:
+        category = await session.scalar(
+                        db.select(Category).where(
+                            fn.lower(Category.type) == fn.lower(category_type)
+                        )
+                   )
+        if category:
+            return error_response(
+                f"Category '{category_type}' already exists.",
+                400
+            )
+
+        try:
+            category = Category(category_type)
+            session.add(category)
+            await session.commit()
+            category_id = category.id
+        except Exception:
+            await session.rollback()
+            print(sys.exc_info())
+            return error_response(
+                'Server error. New category could not be created.',
+                500
+            )
+
+    data_version.bump()
+    category_cache.invalidate()
+    return jsonify({
+        'success': True,
+        'category_id': category_id,
+    })
+
+
+# Delete a specific category
+# ---------------------------------------------------------------------
+async def delete_category(request):
+    category_id = request.path_params['category_id']
+    async with request.app.state.sessions() as session:
+        category = await session.get(Category, category_id)
+        if category is None:
+            abort(404)
+
+        try:
+            await session.delete(category)
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            print(sys.exc_info())
+            return error_response(
+                f"Server error. Category id'{category_id} "
+                "could not be deleted.'",
+                500
+            )
+
+    data_version.bump()
+    category_cache.invalidate()
+    # questions of the category are deleted along with it
+    search_engine.reset()
+    return jsonify({
+        'success': True,
+    })
+
+
+# Pick a random question, see select_random_question() in app.py
+# ---------------------------------------------------------------------
+async def select_random_question(session, pool, previous_questions):
+    low, high = (await session.execute(
+                    question_id_range_statement(pool)
+                 )).one()
+    if low is None:
+        return None
+    ids = draw_question_ids(low, high, previous_questions)
+    if ids:
+        question = first_drawn_question(
+                        (await session.execute(
+                            drawn_questions_statement(pool, ids)
+                        )).scalars(),
+                        ids
+                   )
+        if question is not None:
+            return question
+    return await session.scalar(
+                random_question_statement(pool, set(previous_questions))
+           )
+
+
+# Get the next question
+# ---------------------------------------------------------------------
+async def get_next_question(request):
+    secret_key = request.app.state.config.get('SECRET_KEY')
+    result, category_id, previous_questions = validate_quiz_fields(
+                                                    await get_json(request),
+                                                    secret_key
+                                                )
+    if not result:
+        abort(400)
+
+    async with request.app.state.sessions() as session:
+        pool = []
+        if category_id != 0:
+            category = await session.get(Category, category_id)
+            if category is None:
+                return error_response('Category not found', 404)
+            pool.append(Question.category == category_id)
+
+        # Previous questions must all belong to the current pool, unless
+        # they come from a quiz token, checked when it was issued
+        if not isinstance(previous_questions, QuizProgress):
+            previous_questions = set(previous_questions)
+            if previous_questions:
+                found = await count_questions(
+                            session, *pool,
+                            Question.id.in_(previous_questions)
+                        )
+                if found != len(previous_questions):
+                    return error_response('Invalid previous questions', 400)
+
+        question = await select_random_question(session, pool,
+                                                previous_questions)
+
+    return jsonify({
+        'success': True,
+        'question': question.format() if question is not None else None,
+        'quiz_token': next_quiz_token(
+                        category_id,
+                        previous_questions,
+                        question.id if question is not None else None,
+                        secret_key
+                      ),
+    })
+
+
+# Application
+# ---------------------------------------------------------------------
+def create_async_engine_from_config(config):
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    url = url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+    options = dict(config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    if options.get('poolclass') is NullPool:
+        if url.get_backend_name() == 'postgresql':
+            # PgBouncer in transaction mode can't keep prepared statements
+            options['connect_args'] = {'statement_cache_size': 0}
+    else:
+        # the async engine brings its own queue pool
+        options.pop('poolclass', None)
+    return create_async_engine(url, **options)
+
+
+def load_config(config_object):
+    config_class = config_object
+    if isinstance(config_object, str):
+        module, name = config_object.rsplit('.', 1)
+        config_class = getattr(import_module(module), name)
+    return {
+        key: getattr(config_class, key)
+        for key in dir(config_class) if key.isupper()
+    }
+
+
+def create_asgi_app(config_object='config.DevelopmentConfig'):
+    config = load_config(config_object)
+    engine = create_async_engine_from_config(config)
+
+    async def shutdown():
+        await engine.dispose()
+
+    app = Starlette(
+        routes=[
+            Route('/categories', get_categories, methods=['GET']),
+            Route('/categories', add_category, methods=['POST']),
+            Route('/categories/{category_id:int}', delete_category,
+                  methods=['DELETE']),
+            Route('/categories/{category_id:int}/questions',
+                  get_questions_by_category, methods=['GET']),
+            Route('/questions', get_questions_paginated, methods=['GET']),
+            Route('/questions', dispatch_post_questions, methods=['POST']),
+            Route('/questions/{question_id:int}', delete_question,
+                  methods=['DELETE']),
+            Route('/quizzes', get_next_question, methods=['POST']),
+        ],
+        middleware=[
+            Middleware(CORSMiddleware, allow_origins=['*'],
+                       allow_methods=['*'], allow_headers=['*']),
+        ],
+        exception_handlers={
+            HTTPException: http_error,
+            Exception: server_error,
+        },
+        on_shutdown=[shutdown],
+    )
+    app.state.config = config
+    app.state.engine = engine
+    app.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    category_cache.init_app(app.state)
+    data_version.init_app(app.state)
+    return app
@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app, request
+from werkzeug.exceptions import InternalServerError
+
+# Sub-requests of a single batch
+MAX_BATCH_REQUESTS = 20
+DEFAULT_MAX_WORKERS = 4
+# Sub-requests that don't change anything, and so run in parallel
+PARALLEL_METHODS = ('GET',)
+NESTED_BATCH_ERROR = {
+    'success': False,
+    'error': 400,
+    'message': 'Nested batches are not allowed',
+}
+
+
+# Multi-call batches
+# ---------------------------------------------------------------------
+# The sub-requests of a batch are dispatched in-process, each one in its
+# own application and request context, with the request hooks and the
+# error handlers of a regular request: they get the very same responses,
+# without a round trip each. Consecutive GET sub-requests run in
+# parallel on a pool of BATCH_MAX_WORKERS threads; any other sub-request
+# runs alone, after the ones before it, so a batch sees its own writes.
+#
+# The cookies of the batch request are passed on to the sub-requests,
+# together with those set by the sub-requests before them (such as the
+# read-your-writes cookie, see routing.py). A sub-request routed to the
+# endpoint of the batch itself, however its path is written, is refused
+# rather than dispatched.
+#
+# Each application has its own thread pool, in app.extensions, and the
+# sub-requests are dispatched to the application serving the batch.
+class BatchDispatcher:
+
+    def init_app(self, app):
+        app.extensions['batch_dispatcher'] = BatchExecutor(app)
+
+    def executor(self, app):
+        return app.extensions['batch_dispatcher'].get()
+
+    # Responses of the calls, as (status, JSON body, Set-Cookie headers),
+    # in the order of the calls
+    def dispatch(self, calls, cookies):
+        app = current_app._get_current_object()
+        batch_endpoint = request.endpoint
+        cookies = dict(cookies)
+        responses = []
+        group = []
+        for call in calls + [None]:
+            if call is not None and call[0] in PARALLEL_METHODS:
+                group.append(call)
+                continue
+            if len(group) > 1:
+                responses.extend(self.executor(app).map(
+                    lambda call: self.call(app, *call, cookies,
+                                           batch_endpoint),
+                    group
+                ))
+            elif group:
+                responses.append(
+                    self.call(app, *group[0], cookies, batch_endpoint)
+                )
+            group = []
+            if call is not None:
+                response = self.call(app, *call, cookies, batch_endpoint)
+                responses.append(response)
+                for header in response[2]:
+                    name, _, value = header.split(';', 1)[0].partition('=')
+                    cookies[name] = value
+        return responses
+
+    def call(self, app, method, path, body, cookies, batch_endpoint):
+        headers = {}
+        if cookies:
+            headers['Cookie'] = '; '.join(
+                f'{name}={value}' for name, value in cookies.items()
+            )
+        with app.app_context(), app.test_request_context(
+            path, method=method, json=body, headers=headers
+        ):
+            if request.endpoint == batch_endpoint:
+                return (400, app.json.dumps(
+                            NESTED_BATCH_ERROR
+                        ).encode('utf-8'), [])
+            try:
+                response = app.full_dispatch_request()
+            except Exception:
+                print(sys.exc_info())
+                response = app.make_response(
+                    app.handle_user_exception(InternalServerError())
+                )
+            try:
+                data = response.get_data()
+            finally:
+                response.close()
+
+        if not data:
+            data = b'null'
+        elif not response.is_json:
+            # plain text and NDJSON bodies are returned as strings
+            data = app.json.dumps(
+                data.decode('utf-8', 'replace')
+            ).encode('utf-8')
+        return (response.status_code, data,
+                response.headers.getlist('Set-Cookie'))
+
+
+# Thread pool of the sub-requests of an application, started on the
+# first batch of each worker process
+class BatchExecutor:
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.pool = None
+
+    def get(self):
+        if self.pid != os.getpid():
+            # forked worker: the threads of the pool didn't survive
+            self.reset()
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPoolExecutor(
+                        self.app.config.get('BATCH_MAX_WORKERS',
+                                            DEFAULT_MAX_WORKERS),
+                        thread_name_prefix='batch'
+                    )
+        return self.pool
+
+
+batch_dispatcher = BatchDispatcher()
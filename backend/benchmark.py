@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import time
+import logging
+import random
+import platform
+import argparse
+import tempfile
+import threading
+import multiprocessing
+import http.client
+from statistics import quantiles, median
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from werkzeug.serving import make_server
+from flask.json.provider import DefaultJSONProvider
+from models import (
+    db, Category, Question, QUESTION_COLUMNS, format_question_row
+)
+from migrations import create_tables, drop_tables
+from config import ProductionConfig
+from app import create_app, ITEMS_PER_PAGE
+from search import search_engine
+from cache import category_cache
+from warmup import warmup
+
+CATEGORIES = [
+    'Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports'
+]
+WORDS = [
+    'who', 'what', 'which', 'where', 'painted', 'discovered', 'invented',
+    'largest', 'city', 'river', 'country', 'artist', 'movie', 'team',
+    'world', 'cup', 'organ', 'planet', 'element', 'king', 'queen',
+    'battle', 'year', 'famous', 'first', 'ocean', 'lake', 'mountain',
+]
+SEED_BATCH_SIZE = 10000
+SERIALIZATION_ROWS = 1000
+WORKER_TIMEOUT = 60
+
+# App of the benchmark process, inherited by the workers it forks
+preloaded_app = None
+
+
+# Synthetic data
+# ---------------------------------------------------------------------
+def generate_questions(count, category_ids, seed=0):
+    rnd = random.Random(seed)
+    for i in range(count):
+        words = rnd.choices(WORDS, k=rnd.randint(5, 12))
+        yield {
+            'question': ' '.join(words).capitalize() + f' #{i}?',
+            'answer': ' '.join(rnd.choices(WORDS, k=2)).title(),
+            'difficulty': rnd.randint(1, 5),
+            'category': rnd.choice(category_ids),
+        }
+
+
+def seed_database(count, seed=0):
+    drop_tables()
+    create_tables()
+    db.session.execute(
+        db.insert(Category), [{'type': c} for c in CATEGORIES]
+    )
+    category_ids = db.session.execute(db.select(Category.id)).scalars().all()
+
+    batch = []
+    for row in generate_questions(count, category_ids, seed):
+        batch.append(row)
+        if len(batch) == SEED_BATCH_SIZE:
+            db.session.execute(db.insert(Question), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Question), batch)
+    db.session.commit()
+
+    search_engine.reset()
+    category_cache.invalidate()
+    return category_ids
+
+
+# Scenarios: name -> function(rnd, count, category_ids) returning
+# (method, path, JSON body)
+# ---------------------------------------------------------------------
+def first_page(rnd, count, category_ids):
+    return 'GET', '/questions?page=1', None
+
+
+def random_page(rnd, count, category_ids):
+    page = rnd.randint(1, max(count // ITEMS_PER_PAGE, 1))
+    return 'GET', f'/questions?page={page}', None
+
+
+def keyset_page(rnd, count, category_ids):
+    return 'GET', f'/questions?after_id={rnd.randint(0, count)}', None
+
+
+def categories(rnd, count, category_ids):
+    return 'GET', '/categories', None
+
+
+def category_questions(rnd, count, category_ids):
+    return 'GET', f'/categories/{rnd.choice(category_ids)}/questions', None
+
+
+def quiz(rnd, count, category_ids):
+    category_id = rnd.choice([0] + category_ids)
+    return 'POST', '/quizzes', {
+        'quiz_category': {'id': category_id},
+        'previous_questions': [],
+    }
+
+
+def search(rnd, count, category_ids):
+    return 'POST', '/questions', {
+        'search_term': ' '.join(rnd.sample(WORDS, 2)),
+    }
+
+
+SCENARIOS = {
+    'questions_first_page': first_page,
+    'questions_random_page': random_page,
+    'questions_keyset_page': keyset_page,
+    'categories': categories,
+    'category_questions': category_questions,
+    'quiz': quiz,
+    'search': search,
+}
+
+
+# Drivers
+# ---------------------------------------------------------------------
+def run_test_client(requests, concurrency):
+    client = current_app.test_client()
+    latencies = []
+    errors = 0
+    for method, path, body in requests:
+        start = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        latencies.append(time.perf_counter() - start)
+        errors += response.status_code != 200
+    return latencies, errors
+
+
+def run_wsgi_server(requests, concurrency):
+    server = make_server('127.0.0.1', 0, current_app._get_current_object(),
+                         threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def worker(requests):
+        connection = http.client.HTTPConnection('127.0.0.1', server.port)
+        latencies = []
+        errors = 0
+        for method, path, body in requests:
+            start = time.perf_counter()
+            connection.request(
+                method, path,
+                body=json.dumps(body) if body is not None else None,
+                headers={'Content-Type': 'application/json'}
+            )
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            errors += response.status != 200
+        connection.close()
+        return latencies, errors
+
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            results = list(executor.map(
+                worker, [requests[i::concurrency] for i in range(concurrency)]
+            ))
+    finally:
+        server.shutdown()
+        thread.join()
+
+    return (
+        [latency for latencies, _ in results for latency in latencies],
+        sum(errors for _, errors in results)
+    )
+
+
+DRIVERS = {
+    'test_client': run_test_client,
+    'wsgi_server': run_wsgi_server,
+}
+
+
+def measure(driver, requests, concurrency):
+    start = time.perf_counter()
+    latencies, errors = DRIVERS[driver](requests, concurrency)
+    elapsed = time.perf_counter() - start
+
+    percentiles = quantiles(latencies, n=100, method='inclusive')
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': round(percentiles[49] * 1000, 3),
+        'p99_ms': round(percentiles[98] * 1000, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+    }
+
+
+# CPU time to load SERIALIZATION_ROWS questions and encode them as
+# JSON, with Question instances and the json module (as the list routes
+# used to), and with plain rows and the JSON provider of the app
+# ---------------------------------------------------------------------
+def load_instances():
+    return [
+        q.format() for q in Question.query.order_by(
+            Question.id
+        ).limit(SERIALIZATION_ROWS)
+    ]
+
+
+def load_rows():
+    return [
+        format_question_row(row) for row in db.session.execute(
+            db.select(*QUESTION_COLUMNS).order_by(
+                Question.id
+            ).limit(SERIALIZATION_ROWS)
+        )
+    ]
+
+
+def measure_serialization(repeat):
+    # the provider keeps a weak reference to the app, not to its proxy
+    app = current_app._get_current_object()
+    variants = {
+        'orm_json': (load_instances, DefaultJSONProvider(app)),
+        'core_fast_json': (load_rows, app.json),
+    }
+    result = {}
+    for name, (load, provider) in variants.items():
+        load_times = []
+        encode_times = []
+        for _ in range(repeat):
+            db.session.remove()
+            start = time.process_time()
+            questions = load()
+            loaded = time.process_time()
+            provider.dumps({'questions': questions}, separators=(',', ':'))
+            load_times.append(loaded - start)
+            encode_times.append(time.process_time() - loaded)
+        result[name] = {
+            'load_cpu_ms': round(median(load_times) * 1000, 3),
+            'encode_cpu_ms': round(median(encode_times) * 1000, 3),
+        }
+        result[name]['cpu_ms'] = round(
+            result[name]['load_cpu_ms'] + result[name]['encode_cpu_ms'], 3
+        )
+    result['cpu_ms_saved'] = round(
+        result['orm_json']['cpu_ms'] - result['core_fast_json']['cpu_ms'], 3
+    )
+    return result
+
+
+# Startup time and memory of the workers of a pre-forking server: with
+# --preload, workers are forked from a process that already built the
+# app, and share its memory until they write to it. Without it, every
+# worker starts a new interpreter, imports the app and builds it. Each
+# worker warms up (see warmup.py) and serves one request, then reports
+# its private memory (pages not shared with any other process) and
+# proportional set size from /proc (Linux only).
+# ---------------------------------------------------------------------
+def benchmark_config(database):
+    return type('BenchmarkConfig', (ProductionConfig,), {
+        'SQLALCHEMY_DATABASE_URI': database
+    })
+
+
+def memory_usage_kb():
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup') as file:
+            for line in file:
+                name, _, value = line.partition(':')
+                if name in ('Rss', 'Pss', 'Private_Clean', 'Private_Dirty'):
+                    usage[name] = int(value.split()[0])
+    except OSError:
+        return None, None
+    return usage['Private_Clean'] + usage['Private_Dirty'], usage['Pss']
+
+
+def start_worker(database, queue):
+    app = preloaded_app or create_app(benchmark_config(database),
+                                      setup_db=False)
+    warmup.start(app)
+    warmup.state(app).ready.wait(WORKER_TIMEOUT)
+    response = app.test_client().get('/questions')
+    private_kb, pss_kb = memory_usage_kb()
+    queue.put((response.status_code, private_kb, pss_kb))
+
+
+def measure_workers(app, database, workers):
+    global preloaded_app
+    result = {}
+    for mode, method in (('preload', 'fork'), ('lazy', 'spawn')):
+        preloaded_app = app if mode == 'preload' else None
+        context = multiprocessing.get_context(method)
+        queue = context.Queue()
+        processes = [
+            context.Process(target=start_worker, args=(database, queue))
+            for _ in range(workers)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        reports = [queue.get() for _ in processes]
+        ready = time.perf_counter() - start
+        for process in processes:
+            process.join()
+
+        result[mode] = {
+            'workers_ready_seconds': round(ready, 3),
+            'errors': sum(status != 200 for status, _, _ in reports),
+        }
+        if reports[0][1] is not None:
+            result[mode]['worker_private_kb'] = median(
+                private_kb for _, private_kb, _ in reports
+            )
+            result[mode]['worker_pss_kb'] = median(
+                pss_kb for _, _, pss_kb in reports
+            )
+    preloaded_app = None
+    return result
+
+
+def run_benchmark(sizes, scenarios, drivers, requests, concurrency,
+                  warmup, seed, serialization=0):
+    results = []
+    for size in sizes:
+        start = time.perf_counter()
+        category_ids = seed_database(size, seed)
+        print(f'seeded {size} questions in '
+              f'{time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+        if serialization:
+            result = {
+                'size': size,
+                'scenario': 'serialization',
+                'rows': min(size, SERIALIZATION_ROWS),
+                **measure_serialization(serialization),
+            }
+            print(json.dumps(result), file=sys.stderr)
+            results.append(result)
+
+        for name in scenarios:
+            rnd = random.Random(seed)
+            workload = [
+                SCENARIOS[name](rnd, size, category_ids)
+                for _ in range(warmup + requests)
+            ]
+            for driver in drivers:
+                # warm-up requests prime caches and connections
+                DRIVERS[driver](workload[:warmup], concurrency)
+                result = {
+                    'size': size,
+                    'driver': driver,
+                    'scenario': name,
+                    'concurrency': concurrency if driver != 'test_client'
+                    else 1,
+                    **measure(driver, workload[warmup:], concurrency),
+                }
+                print(json.dumps(result), file=sys.stderr)
+                results.append(result)
+    return results
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the Trivia API on synthetic data.'
+    )
+    parser.add_argument('--database', default=None,
+                        help='database URI (default: a temporary SQLite '
+                             'file)')
+    parser.add_argument('--sizes', default='10000',
+                        help='comma-separated question counts, e.g. '
+                             '10000,100000,1000000')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                        help='comma-separated scenarios')
+    parser.add_argument('--drivers', default=','.join(DRIVERS),
+                        help='comma-separated drivers')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='measured requests per scenario and driver')
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='client threads of the wsgi_server driver')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serialization', type=int, default=0,
+                        metavar='REPEAT',
+                        help='also measure the CPU time to load and encode '
+                             f'{SERIALIZATION_ROWS} questions, REPEAT times')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='also measure the startup time and memory of '
+                             'WORKERS workers, forked from the preloaded '
+                             'app and started from scratch')
+    parser.add_argument('--output', default=None,
+                        help='JSON report file (default: stdout)')
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    directory = None
+    database = arguments.database
+    if database is None:
+        directory = tempfile.TemporaryDirectory()
+        database = f'sqlite:///{directory.name}/benchmark.db'
+
+    # The benchmark seeds and drops its own tables: never point it to
+    # a database holding real data.
+    start = time.perf_counter()
+    app = create_app(benchmark_config(database), setup_db=False)
+    startup = {
+        'scenario': 'startup',
+        'create_app_seconds': round(time.perf_counter() - start, 3),
+    }
+    print(json.dumps(startup), file=sys.stderr)
+
+    with app.app_context():
+        results = run_benchmark(
+            [int(s) for s in arguments.sizes.split(',')],
+            arguments.scenarios.split(','),
+            arguments.drivers.split(','),
+            arguments.requests,
+            arguments.concurrency,
+            arguments.warmup,
+            arguments.seed,
+            arguments.serialization,
+        )
+        dialect = db.engine.dialect.name
+    results.insert(0, startup)
+
+    if arguments.workers:
+        result = {
+            'scenario': 'workers',
+            'workers': arguments.workers,
+            **measure_workers(app, database, arguments.workers),
+        }
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    report = {
+        'meta': {
+            'dialect': dialect,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seed': arguments.seed,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        },
+        'results': results,
+    }
+    if arguments.output:
+        with open(arguments.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+    if directory is not None:
+        directory.cleanup()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import sys
+import time
+import threading
+
+DEFAULT_TTL = 60
+
+
+# Shared backend of the caches
+# ---------------------------------------------------------------------
+def shared_backend(app):
+    url = app.config.get('CACHE_REDIS_URL')
+    if not url:
+        return None
+    # optional dependency, only needed for a shared backend
+    import redis
+    return redis.Redis.from_url(url)
+
+
+# Read-through cache of the category map
+# ---------------------------------------------------------------------
+# Categories are read on every page of questions but almost never
+# change, so the {id: type} map is kept in process memory for a TTL.
+# Write paths call invalidate(). When a shared backend is configured
+# (any client with redis-like get/incr methods), invalidation bumps a
+# shared generation counter, so that every worker process drops its
+# copy on the next read.
+#
+# Readers may also pass the version of the data they serve, such as the
+# version counter of the database their ETag is derived from: the map
+# is then reloaded unless it was loaded at that version or a later one,
+# whichever process or connection changed the categories.
+class CategoryCache:
+    GENERATION_KEY = 'trivia:categories:generation'
+
+    def __init__(self, ttl=DEFAULT_TTL, backend=None):
+        self.ttl = ttl
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.value = None
+        self.generation = None
+        self.version = None
+        self.expires_at = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.ttl = app.config.get('CATEGORY_CACHE_TTL', DEFAULT_TTL)
+        self.backend = shared_backend(app)
+        self.invalidate(shared=False)
+
+    def get(self, loader, version=None):
+        value, ticket = self.lookup(version)
+        if ticket is None:
+            return value
+        value = loader()
+        self.store(value, ticket)
+        return value
+
+    # lookup() and store() split get() for callers that load the value
+    # asynchronously. On a miss, lookup() returns a ticket to store().
+    def lookup(self, version=None):
+        generation = self._shared_generation()
+        with self.lock:
+            if (self.value is not None and
+                    self.generation == generation and
+                    time.monotonic() < self.expires_at and
+                    (version is None or (self.version is not None and
+                                         self.version >= version))):
+                self.hits += 1
+                return self.value, None
+            self.misses += 1
+            return None, (generation, self.invalidations, version)
+
+    def store(self, value, ticket):
+        generation, invalidations, version = ticket
+        with self.lock:
+            # don't store a value loaded before a concurrent invalidation
+            if invalidations == self.invalidations:
+                self.value = value
+                self.generation = generation
+                self.version = version
+                self.expires_at = time.monotonic() + self.ttl
+
+    def invalidate(self, shared=True):
+        with self.lock:
+            self.value = None
+            self.invalidations += 1
+        if shared and self.backend is not None:
+            try:
+                self.backend.incr(self.GENERATION_KEY)
+            except Exception:
+                print(sys.exc_info())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'cached': self.value is not None,
+                'ttl': self.ttl,
+                'shared': self.backend is not None,
+            }
+
+    def _shared_generation(self):
+        if self.backend is None:
+            return None
+        try:
+            return int(self.backend.get(self.GENERATION_KEY) or 0)
+        except Exception:
+            # an unreachable backend must not serve stale data
+            print(sys.exc_info())
+            return object()
+
+
+# Data version
+# ---------------------------------------------------------------------
+# Monotonically increasing counter bumped by the write paths of the
+# app, so that the question snapshot of a worker is reloaded as soon as
+# its own data changes. The counter lives in process memory, or in the
+# shared backend when one is configured: then the snapshots of all the
+# workers are reloaded on every write. ETags are derived from the
+# version counter of the database instead, see conditional_get() in
+# app.py, which also covers writes made by other processes.
+class DataVersion:
+    VERSION_KEY = 'trivia:data:version'
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.version = 0
+
+    def init_app(self, app):
+        self.backend = shared_backend(app)
+
+    def current(self):
+        if self.backend is None:
+            return self.version
+        try:
+            return int(self.backend.get(self.VERSION_KEY) or 0)
+        except Exception:
+            # an unreachable backend must not serve stale data
+            print(sys.exc_info())
+            return object()
+
+    def bump(self):
+        with self.lock:
+            self.version += 1
+            version = self.version
+        if self.backend is None:
+            return version
+        try:
+            return self.backend.incr(self.VERSION_KEY)
+        except Exception:
+            print(sys.exc_info())
+            return None
+
+
+category_cache = CategoryCache()
+data_version = DataVersion()
@@ -0,0 +1,132 @@
+import os
+import sys
+import time
+import threading
+from queue import Queue, Empty
+from concurrent.futures import Future
+from flask import current_app
+from models import db, insert_questions
+from metrics import request_metrics
+
+DEFAULT_MAX_DELAY_MS = 2
+DEFAULT_MAX_ROWS = 100
+# Seconds a request waits for its question to be written
+SUBMIT_TIMEOUT = 30
+
+
+# Group commit of new questions
+# ---------------------------------------------------------------------
+# With GROUP_COMMIT enabled, add_question doesn't insert and commit its
+# question itself: it queues it and waits for its id. A writer thread
+# takes the first queued question, collects the questions queued within
+# GROUP_COMMIT_MAX_DELAY_MS after it, up to GROUP_COMMIT_MAX_ROWS, and
+# writes them with a single multi-row INSERT ... RETURNING in a single
+# transaction. Concurrent requests thus share one commit, and one flush
+# of the database log, for at most the delay in latency. If a batch
+# fails, its questions are written one by one, so that only the failing
+# ones get an error.
+#
+# The size and duration of every batch are recorded in the
+# group_commit_batch_size and group_commit_flush_seconds histograms of
+# /metrics.
+#
+# Each application has its own queue and writer thread, in
+# app.extensions.
+class GroupCommitter:
+
+    def init_app(self, app):
+        app.extensions['group_committer'] = GroupCommitQueue(app)
+
+    def enabled(self):
+        return current_app.config.get('GROUP_COMMIT', False)
+
+    def submit(self, question_data):
+        return current_app.extensions['group_committer'].submit(
+                    question_data
+               )
+
+
+class GroupCommitQueue:
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.queue = Queue()
+        self.writer = None
+
+    # Queues the question and returns its id once it is committed
+    def submit(self, question_data):
+        if self.pid != os.getpid():
+            # forked worker: the writer thread didn't survive the fork
+            self.reset()
+        self._start_writer()
+        future = Future()
+        self.queue.put((question_data, future))
+        return future.result(SUBMIT_TIMEOUT)
+
+    def _start_writer(self):
+        if self.writer is not None:
+            return
+        with self.lock:
+            if self.writer is not None:
+                return
+            self.writer = threading.Thread(target=self._write_forever,
+                                           daemon=True)
+        self.writer.start()
+
+    def _write_forever(self):
+        while True:
+            batch = [self.queue.get()]
+            max_delay = self.app.config.get('GROUP_COMMIT_MAX_DELAY_MS',
+                                            DEFAULT_MAX_DELAY_MS) / 1000
+            max_rows = self.app.config.get('GROUP_COMMIT_MAX_ROWS',
+                                           DEFAULT_MAX_ROWS)
+            deadline = time.monotonic() + max_delay
+            while len(batch) < max_rows:
+                try:
+                    batch.append(self.queue.get(
+                        timeout=max(deadline - time.monotonic(), 0)
+                    ))
+                except Empty:
+                    break
+            try:
+                self.flush(batch)
+            except Exception as error:
+                print(sys.exc_info())
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def flush(self, batch):
+        start = time.perf_counter()
+        with self.app.app_context():
+            try:
+                question_ids = self.insert([data for data, _ in batch])
+            except Exception:
+                print(sys.exc_info())
+                question_ids = None
+
+            if question_ids is not None:
+                for (_, future), question_id in zip(batch, question_ids):
+                    future.set_result(question_id)
+            else:
+                for data, future in batch:
+                    try:
+                        future.set_result(self.insert([data])[0])
+                    except Exception as error:
+                        future.set_exception(error)
+
+        request_metrics.observe('group_commit_batch_size', (), len(batch))
+        request_metrics.observe('group_commit_flush_seconds', (),
+                                time.perf_counter() - start)
+
+    def insert(self, rows):
+        with db.engine.begin() as connection:
+            return insert_questions(connection, rows)
+
+
+group_committer = GroupCommitter()
@@ -0,0 +1,22 @@
+from config import METRICS_DIR
+from metrics import clear_metrics_dir, mark_process_dead
+
+# Gunicorn settings
+# ---------------------------------------------------------------------
+# Loaded by gunicorn from the directory it is started in, e.g.:
+#
+#   gunicorn --preload --workers 4 wsgi:app
+#
+# With METRICS_DIR set, the files of the workers of a previous run are
+# removed when the master process starts, and the file of every worker
+# that exits is merged into a single file, see metrics.py.
+
+
+def on_starting(server):
+    if METRICS_DIR:
+        clear_metrics_dir(METRICS_DIR)
+
+
+def child_exit(server, worker):
+    if METRICS_DIR:
+        mark_process_dead(worker.pid, METRICS_DIR)
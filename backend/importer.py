@@ -0,0 +1,140 @@
+import io
+import csv
+import sys
+import json
+import time
+from itertools import islice
+from models import db, Question
+
+DEFAULT_BATCH_SIZE = 1000
+COLUMNS = ('question', 'answer', 'difficulty', 'category')
+FORMATS = ('jsonl', 'csv')
+
+
+# Stream parsers
+# ---------------------------------------------------------------------
+# Both yield (line number, row dict or None) one row at a time, so that
+# files of any size are imported with flat memory use.
+def read_jsonl(stream):
+    for line_number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row if isinstance(row, dict) else None
+
+
+def read_csv(stream):
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, row
+
+
+def read_rows(stream, format):
+    if format == 'csv':
+        return read_csv(stream)
+    return read_jsonl(stream)
+
+
+# Question importer
+# ---------------------------------------------------------------------
+# Rows are validated with the rules of the add question endpoint, and
+# their category is checked against the categories loaded once before
+# the import. Valid rows of a batch are written in one transaction,
+# with COPY on PostgreSQL and an executemany INSERT elsewhere.
+class QuestionImporter:
+
+    def __init__(self, validate, categories, batch_size=DEFAULT_BATCH_SIZE):
+        self.validate = validate
+        self.categories = set(categories)
+        self.batch_size = batch_size
+
+    def run(self, rows):
+        report = {
+            'imported': 0,
+            'rejected': 0,
+            'batches': 0,
+            'errors': [],
+        }
+        start = time.perf_counter()
+
+        rows = iter(rows)
+        while True:
+            batch = list(islice(rows, self.batch_size))
+            if not batch:
+                break
+            report['batches'] += 1
+            imported, errors = self.import_batch(batch)
+            report['imported'] += imported
+            report['rejected'] += len(batch) - imported
+            if errors:
+                report['errors'].append({
+                    'batch': report['batches'],
+                    'errors': errors,
+                })
+
+        elapsed = time.perf_counter() - start
+        report['seconds'] = round(elapsed, 3)
+        report['rows_per_second'] = round(
+                                        report['imported'] / elapsed
+                                    ) if elapsed else 0
+        return report
+
+    def import_batch(self, batch):
+        valid = []
+        errors = []
+        for line_number, row in batch:
+            data = self.validate(row) if row is not None else None
+            if data is None:
+                errors.append({
+                    'line': line_number,
+                    'message': 'Invalid question data',
+                })
+            elif data['category'] not in self.categories:
+                errors.append({
+                    'line': line_number,
+                    'message': 'Category not found',
+                })
+            else:
+                valid.append(data)
+
+        if not valid:
+            return 0, errors
+
+        try:
+            self.write(valid)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            print(sys.exc_info())
+            errors.append({
+                'line': batch[0][0],
+                'message': 'Server error. The batch could not be written.',
+            })
+            return 0, errors
+
+        return len(valid), errors
+
+    def write(self, rows):
+        connection = db.session.connection()
+        if connection.dialect.name != 'postgresql':
+            connection.execute(db.insert(Question.__table__), rows)
+            return
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[c] for c in COLUMNS])
+        buffer.seek(0)
+
+        cursor = connection.connection.dbapi_connection.cursor()
+        try:
+            cursor.copy_expert(
+                f'COPY questions ({", ".join(COLUMNS)}) '
+                'FROM STDIN WITH (FORMAT csv)',
+                buffer
+            )
+        finally:
+            cursor.close()
@@ -0,0 +1,118 @@
+import re
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    # optional dependency: without it, responses are encoded by the
+    # json module of the standard library
+    import orjson
+except ImportError:
+    orjson = None
+
+# Exponent of a float written by orjson (1e16 and 1e-7 where the json
+# module writes 1e+16 and 1e-07). It may also match text inside a
+# string, which only costs a needless fallback. Starting with a literal
+# keeps the search about as fast as the encoding.
+EXPONENT = re.compile(rb'e-?[0-9]')
+# Floats from 1e-5 to 1e-4, written by orjson without an exponent
+# (0.00001 where the json module writes 1e-05)
+SMALL_FLOAT = b'0.0000'
+
+
+# Fast JSON encoding
+# ---------------------------------------------------------------------
+# orjson encodes responses several times faster than the json module.
+# The output is kept byte for byte identical to the JSON provider of
+# Flask (sorted keys, ASCII only, compact or indented by 2), and
+# anything orjson would write differently is encoded with the json
+# module instead:
+# - strings with non-ASCII characters, escaped by the json module
+# - floats in exponent notation, or below 1e-4
+# - dictionaries with keys other than strings, except the {id: name}
+#   maps of the top level: orjson sorts keys as strings and the json
+#   module sorts ids as numbers, so these maps, and the top level
+#   holding them, are joined here in the order of the json module, and
+#   orjson rejects any other
+# Dates and dataclasses, which orjson would encode natively, and types
+# orjson doesn't support, are left to the default() hook of Flask. NaN
+# and infinite floats, which orjson writes as null, never occur in the
+# responses of this API.
+def fast_dumps(obj, indent=None, default=None):
+    if orjson is None:
+        return None
+    option = (orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME |
+              orjson.OPT_PASSTHROUGH_DATACLASS)
+    if indent == 2:
+        option |= orjson.OPT_INDENT_2
+    elif indent is not None:
+        return None
+
+    try:
+        if isinstance(obj, dict) and any(
+            isinstance(value, dict) and not string_keys(value)
+            for value in obj.values()
+        ):
+            data = dumps_object(obj, option, default)
+        else:
+            data = orjson.dumps(obj, default=default, option=option)
+    except TypeError:
+        return None
+    if (data is None or not data.isascii() or EXPONENT.search(data) or
+            SMALL_FLOAT in data):
+        return None
+    return data.decode('ascii')
+
+
+def string_keys(mapping):
+    return all(type(key) is str for key in mapping)
+
+
+# A top-level dictionary with {id: name} maps, keys sorted as the json
+# module does, or None if they can't be
+def dumps_object(obj, option, default):
+    if not string_keys(obj):
+        return None
+    items = []
+    for key in sorted(obj):
+        value = obj[key]
+        if isinstance(value, dict) and not string_keys(value):
+            if not all(type(id) is int for id in value):
+                return None
+            value = join_object([
+                (b'"%d"' % id,
+                 orjson.dumps(value[id], default=default, option=option))
+                for id in sorted(value)
+            ], option)
+        else:
+            value = orjson.dumps(value, default=default, option=option)
+        items.append((orjson.dumps(key), value))
+    return join_object(items, option)
+
+
+def join_object(items, option):
+    if not items:
+        return b'{}'
+    if not option & orjson.OPT_INDENT_2:
+        return b'{%s}' % b','.join(
+            key + b':' + value for key, value in items
+        )
+    # values are indented one more level inside the object
+    return b'{\n  %s\n}' % b',\n  '.join(
+        key + b': ' + value.replace(b'\n', b'\n  ')
+        for key, value in items
+    )
+
+
+class FastJSONProvider(DefaultJSONProvider):
+
+    def dumps(self, obj, **kwargs):
+        if (self.ensure_ascii and self.sort_keys and
+                set(kwargs) <= {'indent', 'separators'} and
+                kwargs.get('separators', (',', ':')) == (',', ':')):
+            data = fast_dumps(obj, kwargs.get('indent'), self.default)
+            if data is not None:
+                return data
+        return super().dumps(obj, **kwargs)
+
+
+def fast_json_provider(app):
+    return FastJSONProvider(app) if orjson is not None else app.json
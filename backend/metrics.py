@@ -0,0 +1,304 @@
+import os
+import json
+import time
+import threading
+from bisect import bisect_left
+from flask import g, request
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0
+)
+SIZE_BUCKETS = (
+    128, 512, 1024, 4096, 16384, 65536, 262144, 1048576
+)
+BATCH_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+LABELS = ('endpoint', 'method', 'status')
+# name: (description, bucket bounds, label names)
+HISTOGRAMS = {
+    'http_request_duration_seconds': (
+        'Request latency by endpoint, method and status.', LATENCY_BUCKETS,
+        LABELS
+    ),
+    'http_response_size_bytes': (
+        'Response body size by endpoint, method and status.', SIZE_BUCKETS,
+        LABELS
+    ),
+    'group_commit_batch_size': (
+        'Questions written by a group commit.', BATCH_BUCKETS, ()
+    ),
+    'group_commit_flush_seconds': (
+        'Duration of a group commit.', LATENCY_BUCKETS, ()
+    ),
+}
+FLUSH_INTERVAL = 1.0
+
+
+# Request metrics
+# ---------------------------------------------------------------------
+# Every request is timed between before_request and after_request and
+# recorded in per-endpoint histograms, under a single lock. The cost is
+# a couple of clock reads and a bisect per request.
+#
+# When METRICS_DIR is configured, each worker process also writes its
+# snapshot to its own file in that directory, at most once a second
+# from a background thread, and /metrics merges the files of all
+# workers. Files are only ever written by their owner and replaced
+# atomically, so concurrent workers never corrupt each other's data.
+# Counts of workers that exited are kept; only their in-flight
+# requests are dropped. The master process of the server empties the
+# directory when it starts, and merges the file of every worker that
+# exits into a single file, so that files don't pile up as workers are
+# replaced, see gunicorn.conf.py.
+class RequestMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.directory = lambda: None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {name: {} for name in HISTOGRAMS}
+            self.in_flight = 0
+            self.pid = os.getpid()
+            self.flusher = None
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+        self.directory = lambda: app.config.get('METRICS_DIR')
+
+    def before_request(self):
+        if self.pid != os.getpid():
+            # forked worker: start from clean counters of its own
+            self.reset()
+        g.metrics_start = time.perf_counter()
+        with self.lock:
+            self.in_flight += 1
+
+    def after_request(self, response):
+        start = g.pop('metrics_start', None)
+        if start is None:
+            return response
+
+        # view name, without the name of the blueprint serving it
+        endpoint = request.endpoint or 'unmatched'
+        labels = (
+            endpoint.rpartition('.')[2],
+            request.method,
+            str(response.status_code)
+        )
+        size = response.calculate_content_length() or 0
+        with self.lock:
+            self.in_flight -= 1
+            self._observe('http_request_duration_seconds', labels,
+                          time.perf_counter() - start)
+            self._observe('http_response_size_bytes', labels, size)
+
+        self._start_flusher()
+        return response
+
+    def teardown_request(self, error):
+        # after_request doesn't run if the response couldn't be built
+        if g.pop('metrics_start', None) is not None:
+            with self.lock:
+                self.in_flight -= 1
+
+    # Records a value of a histogram outside of the request hooks
+    def observe(self, name, labels, value):
+        if self.pid != os.getpid():
+            self.reset()
+        with self.lock:
+            self._observe(name, labels, value)
+        self._start_flusher()
+
+    def _observe(self, name, labels, value):
+        series = self.histograms[name].get(labels)
+        if series is None:
+            series = self.histograms[name][labels] = {
+                'buckets': [0] * (len(HISTOGRAMS[name][1]) + 1),
+                'sum': 0.0,
+                'count': 0,
+            }
+        series['buckets'][bisect_left(HISTOGRAMS[name][1], value)] += 1
+        series['sum'] += value
+        series['count'] += 1
+
+    # Snapshots and multi-process aggregation
+    # -----------------------------------------------------------------
+    def snapshot(self):
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'in_flight': self.in_flight,
+                'histograms': {
+                    name: [
+                        [list(labels), dict(series, buckets=list(
+                            series['buckets']
+                        ))]
+                        for labels, series in histogram.items()
+                    ]
+                    for name, histogram in self.histograms.items()
+                },
+            }
+
+    def flush(self):
+        directory = self.directory()
+        if not directory:
+            return
+        path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as file:
+            json.dump(self.snapshot(), file)
+        os.replace(path + '.tmp', path)
+
+    def _start_flusher(self):
+        if self.flusher is not None or not self.directory():
+            return
+        with self.lock:
+            if self.flusher is not None:
+                return
+            self.flusher = threading.Thread(target=self._flush_forever,
+                                            daemon=True)
+        self.flusher.start()
+
+    def _flush_forever(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+    def collect(self):
+        directory = self.directory()
+        if not directory:
+            return [self.snapshot()]
+
+        self.flush()
+        snapshots = []
+        for name in os.listdir(directory):
+            if not (name.startswith('metrics-') and name.endswith('.json')):
+                continue
+            try:
+                with open(os.path.join(directory, name)) as file:
+                    snapshots.append(json.load(file))
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    # Prometheus text exposition format
+    # -----------------------------------------------------------------
+    def render(self):
+        snapshots = self.collect()
+        histograms = merge_histograms(snapshots)
+        in_flight = sum(
+            snapshot['in_flight'] for snapshot in snapshots
+            if process_alive(snapshot['pid'])
+        )
+
+        lines = [
+            '# HELP http_requests_in_flight Requests being served.',
+            '# TYPE http_requests_in_flight gauge',
+            f'http_requests_in_flight {in_flight}',
+        ]
+        for name, (description, bounds, names) in HISTOGRAMS.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, series in sorted(histograms[name].items()):
+                label_text = ','.join(
+                    f'{k}="{v}"' for k, v in zip(names, labels)
+                )
+                cumulative = 0
+                for bound, count in zip(bounds + ('+Inf',),
+                                        series['buckets']):
+                    cumulative += count
+                    lines.append(
+                        f'{name}_bucket{{'
+                        f'{label_text + "," if label_text else ""}'
+                        f'le="{bound}"}} {cumulative}'
+                    )
+                label_text = f'{{{label_text}}}' if label_text else ''
+                lines.append(f'{name}_sum{label_text} {series["sum"]}')
+                lines.append(
+                    f'{name}_count{label_text} {series["count"]}'
+                )
+        return '\n'.join(lines) + '\n'
+
+
+def merge_histograms(snapshots):
+    histograms = {name: {} for name in HISTOGRAMS}
+    for snapshot in snapshots:
+        for name, series_list in snapshot['histograms'].items():
+            if name not in histograms:
+                continue
+            for labels, series in series_list:
+                merged = histograms[name].setdefault(tuple(labels), {
+                    'buckets': [0] * len(series['buckets']),
+                    'sum': 0.0,
+                    'count': 0,
+                })
+                for i, count in enumerate(series['buckets']):
+                    merged['buckets'][i] += count
+                merged['sum'] += series['sum']
+                merged['count'] += series['count']
+    return histograms
+
+
+# Metrics files of the workers, for the master process of the server
+# ---------------------------------------------------------------------
+def clear_metrics_dir(directory):
+    os.makedirs(directory, exist_ok=True)
+    for name in os.listdir(directory):
+        if name.startswith('metrics-') and name.endswith(('.json', '.tmp')):
+            os.remove(os.path.join(directory, name))
+
+
+# Merges the file of a worker that exited into the file of all exited
+# workers (pid 0, so never alive), and removes it
+def mark_process_dead(pid, directory):
+    path = os.path.join(directory, f'metrics-{pid}.json')
+    dead_path = os.path.join(directory, 'metrics-dead.json')
+    snapshots = []
+    for name in (dead_path, path):
+        try:
+            with open(name) as file:
+                snapshots.append(json.load(file))
+        except (OSError, ValueError):
+            continue
+    if not os.path.exists(path):
+        return
+
+    snapshot = {
+        'pid': 0,
+        'in_flight': 0,
+        'histograms': {
+            name: [[list(labels), series]
+                   for labels, series in histogram.items()]
+            for name, histogram in merge_histograms(snapshots).items()
+        },
+    }
+    with open(dead_path + '.tmp', 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(dead_path + '.tmp', dead_path)
+    os.remove(path)
+    if os.path.exists(path + '.tmp'):
+        # left by a worker killed while writing its file
+        os.remove(path + '.tmp')
+
+
+def process_alive(pid):
+    if pid == os.getpid():
+        return True
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+request_metrics = RequestMetrics()
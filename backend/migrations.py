@@ -0,0 +1,311 @@
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, BigInteger, String, DateTime, text,
+    inspect
+)
+from sqlalchemy import func as fn
+from sqlalchemy.schema import CreateIndex
+from models import db, Category, Question
+
+# Key of the PostgreSQL advisory lock held while migrating, so workers
+# starting together don't apply the same migration twice
+MIGRATION_LOCK_KEY = 0x7472697669610001
+
+schema_migrations = Table(
+    'schema_migrations',
+    MetaData(),
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False, server_default=fn.now()),
+)
+
+# Version of the question bank, bumped by triggers on every change to
+# the questions or categories, whoever makes it, and total number of
+# questions, kept by triggers like the counts of the categories
+question_bank_version = Table(
+    'question_bank_version',
+    MetaData(),
+    Column('id', Integer, primary_key=True),
+    Column('version', BigInteger, nullable=False),
+    Column('question_count', Integer, nullable=False, server_default='0'),
+)
+VERSIONED_TABLES = ('questions', 'categories')
+
+
+# Migrations
+# ---------------------------------------------------------------------
+# create_all() creates missing tables with all their indexes, but leaves
+# existing tables untouched. Changes to existing tables are versioned
+# migrations: each one is applied once, in order, in its own transaction
+# and recorded in schema_migrations. They must be safe to run on a fresh
+# database where create_all() already created the objects.
+def create_index(connection, table, name):
+    # IF NOT EXISTS: the SQLite inspector doesn't report expression
+    # indexes, so checkfirst would miss them
+    index = next(i for i in table.indexes if i.name == name)
+    connection.execute(CreateIndex(index, if_not_exists=True))
+
+
+def add_search_index(connection):
+    if connection.dialect.name == 'postgresql':
+        create_index(connection, Question.__table__, 'ix_questions_search')
+
+
+def add_category_indexes(connection):
+    # fails if categories already differ only by case: merge them first
+    create_index(connection, Category.__table__, 'ix_categories_type_lower')
+    create_index(connection, Question.__table__, 'ix_questions_category')
+    create_index(connection, Question.__table__, 'ix_questions_category_id')
+
+
+def add_question_bank_version(connection):
+    question_bank_version.create(connection, checkfirst=True)
+    if connection.scalar(db.select(fn.count(question_bank_version.c.id))):
+        return
+    connection.execute(db.insert(question_bank_version).values(
+        id=1,
+        version=0
+    ))
+
+    create_version_triggers(connection, VERSIONED_TABLES)
+
+
+def create_version_triggers(connection, tables):
+    if connection.dialect.name == 'postgresql':
+        # one bump per statement, not per row
+        connection.execute(text(
+            'CREATE OR REPLACE FUNCTION bump_question_bank_version() '
+            'RETURNS trigger AS $$ BEGIN '
+            'UPDATE question_bank_version SET version = version + 1; '
+            'RETURN NULL; '
+            'END; $$ LANGUAGE plpgsql'
+        ))
+        for table in tables:
+            connection.execute(text(
+                f'DROP TRIGGER IF EXISTS {table}_version ON {table}'
+            ))
+            connection.execute(text(
+                f'CREATE TRIGGER {table}_version '
+                f'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} '
+                f'FOR EACH STATEMENT '
+                f'EXECUTE PROCEDURE bump_question_bank_version()'
+            ))
+    else:
+        for table in tables:
+            for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                connection.execute(text(
+                    f'CREATE TRIGGER IF NOT EXISTS '
+                    f'{table}_{operation.lower()}_version '
+                    f'AFTER {operation} ON {table} BEGIN '
+                    f'UPDATE question_bank_version SET version = version + 1; '
+                    f'END'
+                ))
+
+
+def cascade_question_deletes(connection):
+    # questions.category references categories ON DELETE CASCADE, so
+    # that the questions of a category are deleted with a single
+    # statement, without being loaded by the application
+    if connection.dialect.name == 'postgresql':
+        for foreign_key in inspect(connection).get_foreign_keys('questions'):
+            if foreign_key['constrained_columns'] == ['category']:
+                connection.execute(text(
+                    f'ALTER TABLE questions '
+                    f'DROP CONSTRAINT "{foreign_key["name"]}"'
+                ))
+        connection.execute(text(
+            'ALTER TABLE questions ADD CONSTRAINT questions_category_fkey '
+            'FOREIGN KEY (category) REFERENCES categories (id) '
+            'ON UPDATE CASCADE ON DELETE CASCADE'
+        ))
+        return
+
+    # SQLite can't alter a constraint: the table is rebuilt, then its
+    # indexes and triggers
+    table = Question.__table__
+    for index in table.indexes:
+        connection.execute(text(f'DROP INDEX IF EXISTS {index.name}'))
+    connection.execute(text('ALTER TABLE questions RENAME TO questions_old'))
+    table.create(connection)
+    columns = ', '.join(column.name for column in table.columns)
+    connection.execute(text(
+        f'INSERT INTO questions ({columns}) '
+        f'SELECT {columns} FROM questions_old'
+    ))
+    connection.execute(text('DROP TABLE questions_old'))
+    create_version_triggers(connection, ['questions'])
+
+
+def add_question_counts(connection):
+    columns = {
+        table: {c['name'] for c in inspect(connection).get_columns(table)}
+        for table in ('categories', 'question_bank_version')
+    }
+    for table in columns:
+        if 'question_count' not in columns[table]:
+            connection.execute(text(
+                f'ALTER TABLE {table} ADD COLUMN question_count '
+                f'INTEGER NOT NULL DEFAULT 0'
+            ))
+
+    # the triggers lock the questions on PostgreSQL until the end of
+    # the migration, so no write is missed between them and the counts
+    create_count_triggers(connection)
+    connection.execute(text(
+        'UPDATE categories SET question_count = ('
+        'SELECT count(*) FROM questions '
+        'WHERE questions.category = categories.id)'
+    ))
+    connection.execute(text(
+        'UPDATE question_bank_version SET question_count = ('
+        'SELECT count(*) FROM questions)'
+    ))
+
+
+def create_count_triggers(connection):
+    if connection.dialect.name == 'postgresql':
+        # Statement triggers reading the transition tables: a statement
+        # writing many questions updates each category once
+        changes = {
+            'insert': ('NEW TABLE AS inserted', [('inserted', '+')]),
+            'delete': ('OLD TABLE AS deleted', [('deleted', '-')]),
+            'update': ('OLD TABLE AS deleted NEW TABLE AS inserted',
+                       [('deleted', '-'), ('inserted', '+')]),
+        }
+        for operation, (transition, tables) in changes.items():
+            updates = ''.join(
+                f'UPDATE categories SET question_count = '
+                f'question_count {sign} changed.count '
+                f'FROM (SELECT category, count(*) AS count FROM {table} '
+                f'GROUP BY category) AS changed '
+                f'WHERE categories.id = changed.category; '
+                for table, sign in tables
+            )
+            if operation != 'update':
+                updates += (
+                    f'UPDATE question_bank_version SET question_count = '
+                    f'question_count {tables[0][1]} '
+                    f'(SELECT count(*) FROM {tables[0][0]}); '
+                )
+            connection.execute(text(
+                f'CREATE OR REPLACE FUNCTION count_questions_{operation}() '
+                f'RETURNS trigger AS $$ BEGIN {updates}RETURN NULL; '
+                f'END; $$ LANGUAGE plpgsql'
+            ))
+            connection.execute(text(
+                f'DROP TRIGGER IF EXISTS questions_{operation}_count '
+                f'ON questions'
+            ))
+            connection.execute(text(
+                f'CREATE TRIGGER questions_{operation}_count '
+                f'AFTER {operation.upper()} ON questions '
+                f'REFERENCING {transition} FOR EACH STATEMENT '
+                f'EXECUTE PROCEDURE count_questions_{operation}()'
+            ))
+
+        connection.execute(text(
+            'CREATE OR REPLACE FUNCTION count_questions_truncate() '
+            'RETURNS trigger AS $$ BEGIN '
+            'UPDATE categories SET question_count = 0; '
+            'UPDATE question_bank_version SET question_count = 0; '
+            'RETURN NULL; '
+            'END; $$ LANGUAGE plpgsql'
+        ))
+        connection.execute(text(
+            'DROP TRIGGER IF EXISTS questions_truncate_count ON questions'
+        ))
+        connection.execute(text(
+            'CREATE TRIGGER questions_truncate_count '
+            'AFTER TRUNCATE ON questions FOR EACH STATEMENT '
+            'EXECUTE PROCEDURE count_questions_truncate()'
+        ))
+        return
+
+    triggers = {
+        'insert': ('INSERT', '', [('NEW', '+')]),
+        'delete': ('DELETE', '', [('OLD', '-')]),
+        'update': ('UPDATE OF category',
+                   'WHEN OLD.category IS NOT NEW.category',
+                   [('OLD', '-'), ('NEW', '+')]),
+    }
+    for name, (event, condition, rows) in triggers.items():
+        updates = ''.join(
+            f'UPDATE categories SET question_count = question_count '
+            f'{sign} 1 WHERE id = {row}.category; '
+            for row, sign in rows
+        )
+        if name != 'update':
+            updates += (
+                f'UPDATE question_bank_version SET question_count = '
+                f'question_count {rows[0][1]} 1; '
+            )
+        connection.execute(text(
+            f'CREATE TRIGGER IF NOT EXISTS questions_{name}_count '
+            f'AFTER {event} ON questions {condition} BEGIN {updates}END'
+        ))
+
+
+MIGRATIONS = [
+    (1, 'Full-text search index of questions', add_search_index),
+    (2, 'Indexes of category lookups', add_category_indexes),
+    (3, 'Version counter of the question bank', add_question_bank_version),
+    (4, 'Delete questions along with their category',
+     cascade_question_deletes),
+    (5, 'Question counts of the categories', add_question_counts),
+]
+
+
+def applied_migrations(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return set(connection.scalars(db.select(schema_migrations.c.version)))
+
+
+def migrate(engine):
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        with engine.begin() as connection:
+            if connection.dialect.name == 'postgresql':
+                connection.execute(
+                    text('SELECT pg_advisory_xact_lock(:key)'),
+                    {'key': MIGRATION_LOCK_KEY}
+                )
+            if version in applied_migrations(connection):
+                continue
+            upgrade(connection)
+            connection.execute(db.insert(schema_migrations).values(
+                version=version,
+                description=description
+            ))
+        applied.append(version)
+    return applied
+
+
+def create_tables():
+    db.create_all()
+    return migrate(db.engine)
+
+
+def drop_tables():
+    db.drop_all()
+    for table in (schema_migrations, question_bank_version):
+        table.drop(db.engine, checkfirst=True)
+
+
+# Query plans
+# ---------------------------------------------------------------------
+# Returns the plan of a statement as text. On PostgreSQL, sequential
+# scans are disabled for the rest of the transaction, so that the plan
+# shows whether an index can serve the query even when the tables are
+# still small: the connection must be rolled back afterwards.
+def explain(connection, statement):
+    sql = str(statement.compile(
+                dialect=connection.dialect,
+                compile_kwargs={'literal_binds': True}
+          ))
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('SET LOCAL enable_seqscan = off'))
+        rows = connection.exec_driver_sql('EXPLAIN ' + sql).all()
+        return '\n'.join(row[0] for row in rows)
+
+    # SQLite: the last column of each row describes a step of the plan
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + sql).all()
+    return '\n'.join(row[-1] for row in rows)
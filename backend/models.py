@@ -1,10 +1,49 @@
+from collections import defaultdict
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, func as fn, literal_column
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import postgresql  # noqa: F401 (text search types)
 
-db = SQLAlchemy()
 
+# Session of a request
+# ---------------------------------------------------------------------
+# The queries of a read-only view run on the engine of the replica the
+# view was routed to, see routing.py, and all others on the primary.
+class RoutingSession(Session):
 
-def create_tables():
-    db.create_all()
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            bind = g.get('read_engine')
+        return super().get_bind(mapper, clause, bind, **kwargs)
+
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# Text search configuration of the PostgreSQL full-text index
+SEARCH_CONFIG = literal_column("'english'::regconfig")
+
+
+# Searchable text of a question. Queries must use the very same
+# expression for PostgreSQL to pick up the GIN index of the questions.
+def search_document(question, answer):
+    return fn.to_tsvector(
+                SEARCH_CONFIG,
+                fn.coalesce(question, '') + ' ' + fn.coalesce(answer, '')
+           )
+
+
+# SQLite only enforces foreign keys, and so ON DELETE CASCADE, when it
+# is asked to on every connection (sqlite3 and aiosqlite drivers)
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if type(dbapi_connection).__module__.startswith(
+        ('sqlite3', 'sqlalchemy.dialects.sqlite')
+    ):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys = ON')
+        cursor.close()
 
 
 class Category(db.Model):
@@ -12,13 +51,23 @@ class Category(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     type = db.Column(db.String)
+    # kept up to date by triggers on the questions table
+    question_count = db.Column(db.Integer, nullable=False, server_default='0')
 
+    # questions are deleted by the database along with their category
+    # (ON DELETE CASCADE), without being loaded
     questions = db.relationship(
                 'Question',
                 back_populates='category_type',
-                cascade='all,delete-orphan'
+                cascade='all,delete-orphan',
+                passive_deletes=True
             )
 
+    # case-insensitive lookups and uniqueness of category names
+    __table_args__ = (
+        db.Index('ix_categories_type_lower', fn.lower(type), unique=True),
+    )
+
     def __init__(self, type):
         self.type = type
 
@@ -44,10 +93,29 @@ class Question(db.Model):
     question = db.Column(db.String)
     answer = db.Column(db.String)
     difficulty = db.Column(db.Integer)
-    category = db.Column(db.Integer, db.ForeignKey('categories.id'))
+    category = db.Column(
+                    db.Integer,
+                    db.ForeignKey(
+                        'categories.id',
+                        name='questions_category_fkey',
+                        onupdate='CASCADE',
+                        ondelete='CASCADE'
+                    )
+               )
 
     category_type = db.relationship('Category', back_populates='questions')
 
+    __table_args__ = (
+        db.Index(
+            'ix_questions_search',
+            search_document(question, answer),
+            postgresql_using='gin'
+        ).ddl_if(dialect='postgresql'),
+        # questions of a category, in id order
+        db.Index('ix_questions_category', category),
+        db.Index('ix_questions_category_id', category, id),
+    )
+
     def __init__(
                 self,
                 question=None,
@@ -83,3 +151,54 @@ class Question(db.Model):
             'category': self.category,
             'difficulty': self.difficulty
         }
+
+
+# Columns of a question as returned by the API, for list queries that
+# select plain rows rather than Question instances
+QUESTION_COLUMNS = (
+    Question.id,
+    Question.question,
+    Question.answer,
+    Question.category,
+    Question.difficulty
+)
+
+
+def format_question_row(row):
+    id, question, answer, category, difficulty = row
+    return {
+        'id': id,
+        'question': question,
+        'answer': answer,
+        'category': category,
+        'difficulty': difficulty
+    }
+
+
+# Inserts question rows with a single statement and returns their ids in
+# the order of the rows. The ids returned by a multi-row insert come in
+# no guaranteed order, so they are matched to the rows by their values:
+# rows with the same values get their ids in ascending order. Values
+# converted by the database (e.g. a number stored as text) can't be
+# matched, and the ids left are given to those rows in ascending order.
+INSERTED_COLUMNS = ('question', 'answer', 'difficulty', 'category')
+
+
+def insert_questions(connection, rows):
+    result = connection.execute(
+        db.insert(Question).values(rows).returning(
+            Question.id, *(getattr(Question, c) for c in INSERTED_COLUMNS)
+        )
+    )
+    ids = defaultdict(list)
+    for id, *values in result:
+        ids[tuple(values)].append(id)
+    for same in ids.values():
+        same.sort(reverse=True)
+
+    question_ids = []
+    for row in rows:
+        same = ids.get(tuple(row[c] for c in INSERTED_COLUMNS))
+        question_ids.append(same.pop() if same else None)
+    left = iter(sorted(id for same in ids.values() for id in same))
+    return [id if id is not None else next(left) for id in question_ids]
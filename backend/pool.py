@@ -0,0 +1,71 @@
+import time
+import threading
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+# Connection pool with wait statistics
+# ---------------------------------------------------------------------
+# QueuePool only reports its current state, so checkouts are timed here
+# to tell how long requests wait for a free connection.
+class InstrumentedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def recreate(self):
+        # keep the statistics when the pool is disposed and recreated
+        pool = super().recreate()
+        pool.checkouts = self.checkouts
+        pool.timeouts = self.timeouts
+        pool.wait_seconds = self.wait_seconds
+        pool.max_wait_seconds = self.max_wait_seconds
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except TimeoutError:
+            with self.stats_lock:
+                self.timeouts += 1
+            raise
+        wait = time.perf_counter() - start
+        with self.stats_lock:
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        return connection
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'size': self.size(),
+                'checked_in': self.checkedin(),
+                'checked_out': self.checkedout(),
+                'overflow': max(self.overflow(), 0),
+                'max_overflow': self._max_overflow,
+                'timeout': self._timeout,
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'wait_seconds_max': round(self.max_wait_seconds, 6),
+                'wait_seconds_avg': round(
+                    self.wait_seconds / self.checkouts, 6
+                ) if self.checkouts else 0.0,
+            }
+
+
+def pool_stats(engine):
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        stats = pool.stats()
+    else:
+        stats = {'status': pool.status()}
+    stats['pool'] = type(pool).__name__
+    return stats
@@ -0,0 +1,93 @@
+import time
+from collections import Counter
+from flask import current_app, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_SLOW_QUERY_MS = 200
+DEFAULT_REPEATED_QUERY_THRESHOLD = 3
+
+
+# SQL statements of a request
+# ---------------------------------------------------------------------
+# Engine events count the statements run while serving a request and
+# the time spent in the database, which are returned in a Server-Timing
+# header. Statements slower than SLOW_QUERY_MS are logged with their
+# route. With DETECT_REPEATED_QUERIES (development), a statement run
+# REPEATED_QUERY_THRESHOLD times or more within one request is flagged
+# as a likely N+1 query pattern.
+#
+# The engine events are registered once per process; the settings are
+# read from the application serving the request.
+class QueryTracker:
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         self.after_cursor_execute)
+
+    def before_cursor_execute(self, connection, cursor, statement,
+                              parameters, context, executemany):
+        if has_request_context():
+            context.query_start = time.perf_counter()
+
+    def after_cursor_execute(self, connection, cursor, statement,
+                             parameters, context, executemany):
+        start = getattr(context, 'query_start', None)
+        if start is None or not has_request_context():
+            return
+        duration = time.perf_counter() - start
+
+        stats = g.setdefault('query_stats', {
+            'count': 0,
+            'seconds': 0.0,
+            'statements': Counter(),
+        })
+        stats['count'] += 1
+        stats['seconds'] += duration
+        stats['statements'][statement] += 1
+
+        config = current_app.config
+        if duration * 1000 >= config.get('SLOW_QUERY_MS',
+                                         DEFAULT_SLOW_QUERY_MS):
+            current_app.logger.warning(
+                'Slow query (%.1f ms) in %s %s: %s',
+                duration * 1000, request.method, request.path, statement
+            )
+
+    def after_request(self, response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            response.headers.add('Server-Timing', 'db;dur=0;desc="0 queries"')
+            return response
+
+        response.headers.add(
+            'Server-Timing',
+            f'db;dur={stats["seconds"] * 1000:.2f};'
+            f'desc="{stats["count"]} queries"'
+        )
+
+        config = current_app.config
+        if config.get('DETECT_REPEATED_QUERIES', False):
+            threshold = config.get('REPEATED_QUERY_THRESHOLD',
+                                   DEFAULT_REPEATED_QUERY_THRESHOLD)
+            repeated = {
+                statement: count
+                for statement, count in stats['statements'].items()
+                if count >= threshold
+            }
+            for statement, count in repeated.items():
+                current_app.logger.warning(
+                    'Statement run %d times in %s %s (N+1 queries?): %s',
+                    count, request.method, request.path, statement
+                )
+            if repeated:
+                response.headers['X-Repeated-Queries'] = str(len(repeated))
+        return response
+
+
+query_tracker = QueryTracker()
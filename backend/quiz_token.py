@@ -0,0 +1,136 @@
+import zlib
+import base64
+from itsdangerous import Signer, BadSignature
+
+SALT = 'quiz-progress'
+# Widest range of ids a token covers: 2^20 bits, 128 KB before
+# compression. Larger quizzes fall back to the list of ids.
+MAX_SPAN = 1 << 20
+# Positions of the set bits of every byte value
+BYTE_BITS = [
+    tuple(offset for offset in range(8) if byte >> offset & 1)
+    for byte in range(256)
+]
+
+
+# Quiz progress token
+# ---------------------------------------------------------------------
+# The questions already asked in a quiz are kept as a bitset over the
+# id range they span: bit i is set when question base + i was asked.
+# The bitset is compressed with zlib when that makes it smaller, encoded
+# in URL-safe base64 and signed with the SECRET_KEY of the app, together
+# with the quiz category and the number of questions asked:
+#
+#   <category>.<base>.<count>.<z|r><bitset>.<signature>
+#
+# Ids are allocated in sequence, so the questions of a category span a
+# narrow range and the token stays a few dozen bytes long. A token is
+# read and updated without any query: the ids it holds were checked
+# when they were added, and the signature proves they weren't changed.
+class QuizProgress:
+
+    def __init__(self, category_id, base=0, bits=0, count=0):
+        self.category_id = category_id
+        self.base = base
+        self.bits = bits
+        self.count = count
+        self.overflow = False
+
+    @classmethod
+    def from_ids(cls, category_id, ids):
+        progress = cls(category_id)
+        for id in ids:
+            progress.add(id)
+        return progress
+
+    def __contains__(self, id):
+        return id >= self.base and bool(self.bits >> (id - self.base) & 1)
+
+    def __len__(self):
+        return self.count
+
+    # A single pass over the bytes of the bitset: shifting the integer
+    # bit by bit would copy it once per bit of the span
+    def __iter__(self):
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8,
+                                  'little')
+        for index, byte in enumerate(data):
+            if byte:
+                for offset in BYTE_BITS[byte]:
+                    yield self.base + index * 8 + offset
+
+    def add(self, id):
+        if id in self or self.overflow:
+            return
+        top = self.base + self.bits.bit_length() - 1
+        if self.bits and max(top, id) - min(self.base, id) >= MAX_SPAN:
+            self.overflow = True
+            return
+        if not self.bits:
+            self.base = id
+        elif id < self.base:
+            self.bits <<= self.base - id
+            self.base = id
+        self.bits |= 1 << (id - self.base)
+        self.count += 1
+
+    # Signed token, or None if the ids span more than MAX_SPAN
+    def dumps(self, secret_key):
+        if self.overflow:
+            return None
+        data = self.bits.to_bytes((self.bits.bit_length() + 7) // 8,
+                                  'little')
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = b'z' + compressed
+        else:
+            data = b'r' + data
+        payload = '.'.join([
+            str(self.category_id), str(self.base), str(self.count),
+            base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+        ])
+        return signer(secret_key).sign(payload).decode('ascii')
+
+    # Raises ValueError if the token is invalid or was issued for
+    # another category
+    @classmethod
+    def loads(cls, token, secret_key, category_id):
+        if not isinstance(token, str) or not secret_key:
+            raise ValueError('Invalid quiz token')
+        try:
+            payload = signer(secret_key).unsign(token).decode('ascii')
+        except BadSignature:
+            raise ValueError('Invalid quiz token')
+
+        token_category, base, count, data = payload.split('.')
+        if int(token_category) != category_id:
+            raise ValueError('Quiz token of another category')
+        data = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        if data[:1] == b'z':
+            try:
+                data = zlib.decompress(data[1:])
+            except zlib.error:
+                raise ValueError('Invalid quiz token')
+        else:
+            data = data[1:]
+        return cls(category_id, int(base),
+                   int.from_bytes(data, 'little'), int(count))
+
+
+def signer(secret_key):
+    return Signer(secret_key, salt=SALT)
+
+
+# Token of the progress after question_id is asked, from the progress
+# read from a token or from a list of previous questions
+def next_quiz_token(category_id, previous_questions, question_id,
+                    secret_key):
+    if not secret_key:
+        return None
+    if isinstance(previous_questions, QuizProgress):
+        progress = previous_questions
+    else:
+        progress = QuizProgress.from_ids(category_id, previous_questions)
+    if question_id is not None:
+        progress.add(question_id)
+    return progress.dumps(secret_key)
@@ -0,0 +1,180 @@
+import os
+import math
+import sys
+import time
+import itertools
+import threading
+from functools import wraps
+from flask import current_app, g, request
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+
+# Cookie holding the time until which a client reads from the primary
+READ_PRIMARY_COOKIE = 'read_primary_until'
+# Seconds a replica that failed to connect is left out of the rotation
+DEFAULT_RETRY_SECONDS = 30
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+
+# Read replica routing
+# ---------------------------------------------------------------------
+# Views decorated with read_only, and the search, run their queries on a
+# replica from DB_REPLICA_URIS, picked in turn for every request: the
+# session binds its queries to the engine of that replica (see
+# RoutingSession in models.py). When the pool of a replica has no idle
+# connection, it is connected to before being picked. A replica that
+# fails to connect is left out of the rotation for REPLICA_RETRY_SECONDS
+# and the request goes on with the next one, and finally with the
+# primary. Writes always go to the primary, and so does everything run
+# outside of a read-only view (CLI commands, the snapshot, the group
+# commit writer).
+#
+# Replicas lag behind the primary: with READ_YOUR_WRITES_SECONDS, a
+# successful write sets a cookie sending the reads of that client to the
+# primary for that many seconds, so it sees its own changes.
+class ReplicaRouter:
+
+    def __init__(self):
+        self.app = None
+        self.lock = threading.Lock()
+        self.engines = {}
+        self.reset()
+
+    def reset(self):
+        self.turn = itertools.count()
+        self.down_until = {}
+        self.reads = {}
+        self.failures = {}
+        self.fallbacks = 0
+
+    def init_app(self, app):
+        if self.app is None:
+            os.register_at_fork(after_in_child=self.after_fork)
+        self.app = app
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+    def after_fork(self):
+        # a forked worker opens its own connections to the replicas
+        for engine in self.engines.values():
+            engine.dispose(close=False)
+        self.reset()
+
+    def replica_uris(self):
+        return current_app.config.get('DB_REPLICA_URIS', [])
+
+    def engine(self, uri):
+        engine = self.engines.get(uri)
+        if engine is None:
+            with self.lock:
+                engine = self.engines.get(uri)
+                if engine is None:
+                    engine = create_engine(uri, **current_app.config.get(
+                        'SQLALCHEMY_ENGINE_OPTIONS', {}
+                    ))
+                    self.engines[uri] = engine
+        return engine
+
+    def replica_engines(self):
+        return [self.engine(uri) for uri in self.replica_uris()]
+
+    # Routes the queries of the current request to a replica
+    def use_replica(self):
+        g.read_only = True
+        g.read_engine = self.choose_engine()
+
+    # The request doesn't write by itself, although its method does,
+    # e.g. a batch, whose sub-requests set their own cookies
+    def not_a_write(self):
+        g.read_only = True
+
+    def read_only(self, view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            self.use_replica()
+            return view(*args, **kwargs)
+        return wrapper
+
+    def in_write_window(self):
+        try:
+            until = float(request.cookies.get(READ_PRIMARY_COOKIE, 0))
+        except ValueError:
+            return False
+        return until > time.time()
+
+    # Engine of the next replica up, or None to read from the primary
+    def choose_engine(self):
+        uris = self.replica_uris()
+        if not uris or self.in_write_window():
+            return None
+
+        start = next(self.turn)
+        now = time.monotonic()
+        for offset in range(len(uris)):
+            uri = uris[(start + offset) % len(uris)]
+            if self.down_until.get(uri, 0) > now:
+                continue
+            engine = self.engine(uri)
+            try:
+                if not idle_connections(engine):
+                    # the connection opened here is the one the session
+                    # checks out next
+                    engine.connect().close()
+            except DBAPIError:
+                print(sys.exc_info())
+                self.failures[uri] = self.failures.get(uri, 0) + 1
+                self.down_until[uri] = now + current_app.config.get(
+                    'REPLICA_RETRY_SECONDS', DEFAULT_RETRY_SECONDS
+                )
+                continue
+            self.reads[uri] = self.reads.get(uri, 0) + 1
+            return engine
+
+        self.fallbacks += 1
+        return None
+
+    def before_request(self):
+        # the application context, and so g, may outlive a request
+        g.pop('read_only', None)
+        g.pop('read_engine', None)
+
+    def after_request(self, response):
+        window = current_app.config.get('READ_YOUR_WRITES_SECONDS', 0)
+        if (window and request.method in WRITE_METHODS
+                and not g.get('read_only', False)
+                and response.status_code < 400):
+            response.set_cookie(READ_PRIMARY_COOKIE,
+                                str(round(time.time() + window, 3)),
+                                max_age=math.ceil(window), httponly=True,
+                                samesite='Lax')
+        return response
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            'replicas': [
+                {
+                    'url': make_url(uri).render_as_string(
+                        hide_password=True
+                    ),
+                    'reads': self.reads.get(uri, 0),
+                    'failures': self.failures.get(uri, 0),
+                    'down': self.down_until.get(uri, 0) > now,
+                }
+                for uri in self.replica_uris()
+            ],
+            'fallbacks': self.fallbacks,
+            'read_your_writes_seconds': current_app.config.get(
+                'READ_YOUR_WRITES_SECONDS', 0
+            ),
+        }
+
+
+def idle_connections(engine):
+    # pools without idle connections (NullPool) always connect
+    checkedin = getattr(engine.pool, 'checkedin', None)
+    return checkedin() if checkedin is not None else 0
+
+
+replica_router = ReplicaRouter()
@@ -0,0 +1,181 @@
+import re
+import math
+import threading
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from sqlalchemy import func as fn
+from models import db, Question, SEARCH_CONFIG, search_document
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall((text or '').lower())
+
+
+# In-process inverted index
+# ---------------------------------------------------------------------
+# Used when the database has no full-text search support (e.g. SQLite
+# in tests). Every query token is matched as a prefix, all query tokens
+# must match, and results are ranked by tf-idf over question and answer.
+class InvertedIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.postings = defaultdict(dict)
+        self.documents = {}
+        self.sorted_tokens = None
+
+    def add(self, question_id, *texts):
+        with self.lock:
+            self._add(question_id, texts)
+
+    def discard(self, question_id):
+        with self.lock:
+            self._discard(question_id)
+
+    def build(self, rows):
+        with self.lock:
+            self.clear()
+            for question_id, *texts in rows:
+                self._add(question_id, texts)
+
+    def match(self, tokens, offset, limit):
+        with self.lock:
+            if self.sorted_tokens is None:
+                self.sorted_tokens = sorted(self.postings)
+
+            scores = None
+            for token in set(tokens):
+                token_scores = self._match_prefix(token)
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {
+                        i: s + token_scores[i]
+                        for i, s in scores.items() if i in token_scores
+                    }
+                if not scores:
+                    return [], 0
+
+        ranked = sorted(scores, key=lambda i: (-scores[i], i))
+        return ranked[offset:offset + limit], len(ranked)
+
+    def _add(self, question_id, texts):
+        self._discard(question_id)
+        counts = Counter(t for text in texts for t in tokenize(text))
+        for token, count in counts.items():
+            if token not in self.postings:
+                self.sorted_tokens = None
+            self.postings[token][question_id] = count
+        self.documents[question_id] = counts
+
+    def _discard(self, question_id):
+        for token in self.documents.pop(question_id, ()):
+            postings = self.postings[token]
+            postings.pop(question_id, None)
+            if not postings:
+                del self.postings[token]
+                self.sorted_tokens = None
+
+    def _match_prefix(self, prefix):
+        scores = defaultdict(float)
+        position = bisect_left(self.sorted_tokens, prefix)
+        while (position < len(self.sorted_tokens) and
+               self.sorted_tokens[position].startswith(prefix)):
+            postings = self.postings[self.sorted_tokens[position]]
+            idf = math.log(1 + len(self.documents) / len(postings))
+            for question_id, count in postings.items():
+                scores[question_id] += count * idf
+            position += 1
+        return scores
+
+
+# Search engine
+# ---------------------------------------------------------------------
+# On PostgreSQL questions are matched against a GIN-indexed tsvector
+# expression and ranked with ts_rank. Other databases fall back to the
+# in-process inverted index, which is built lazily on the first search
+# and kept up to date by the write paths of this process.
+class SearchEngine:
+
+    def __init__(self):
+        self.index = InvertedIndex()
+        self.index_ready = False
+
+    def match(self, search_term, offset, limit):
+        tokens = tokenize(search_term)
+        statement = self.statement(
+                        db.engine.dialect.name, tokens, offset, limit
+                    )
+        if statement is not None:
+            return self.page(db.session.execute(statement).all())
+
+        if not self.index_ready:
+            # built from the primary: writes made before the build, and
+            # not applied to a replica yet, would never be indexed
+            self.build_index(db.session.execute(
+                self.index_statement(), bind_arguments={'bind': db.engine}
+            ))
+        return self.index.match(tokens, offset, limit)
+
+    async def match_async(self, session, search_term, offset, limit):
+        tokens = tokenize(search_term)
+        statement = self.statement(
+                        session.bind.dialect.name, tokens, offset, limit
+                    )
+        if statement is not None:
+            return self.page((await session.execute(statement)).all())
+
+        if not self.index_ready:
+            self.build_index(await session.execute(self.index_statement()))
+        return self.index.match(tokens, offset, limit)
+
+    def add(self, question_id, question, answer):
+        if self.index_ready:
+            self.index.add(question_id, question, answer)
+
+    def discard(self, question_id):
+        if self.index_ready:
+            self.index.discard(question_id)
+
+    def reset(self):
+        self.index_ready = False
+
+    def build_index(self, rows):
+        self.index.build(rows)
+        self.index_ready = True
+
+    def index_statement(self):
+        return db.select(Question.id, Question.question, Question.answer)
+
+    def page(self, rows):
+        return [r.id for r in rows], rows[0].total if rows else 0
+
+    # Statement of a page of matching question ids, or None if the
+    # in-process index must be used
+    def statement(self, dialect, tokens, offset, limit):
+        criteria = []
+        order = [Question.id]
+        if tokens:
+            if dialect != 'postgresql':
+                return None
+            document = search_document(Question.question, Question.answer)
+            query = fn.to_tsquery(
+                        SEARCH_CONFIG,
+                        ' & '.join(f'{t}:*' for t in tokens)
+                    )
+            criteria.append(document.bool_op('@@')(query))
+            order.insert(0, fn.ts_rank(document, query).desc())
+
+        return db.select(
+                    Question.id, fn.count().over().label('total')
+               ).where(
+                    *criteria
+               ).order_by(*order).offset(offset).limit(limit)
+
+
+search_engine = SearchEngine()
@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+import random
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from flask import current_app
+from models import db, Category, Question, QUESTION_COLUMNS
+from cache import data_version
+from migrations import question_bank_version
+
+DEFAULT_POLL_INTERVAL = 1.0
+# Random positions drawn for a quiz question before listing the
+# remaining questions
+RANDOM_DRAWS = 8
+
+
+# Snapshot of the question bank
+# ---------------------------------------------------------------------
+# Questions are held as columns: ids in an array of machine integers,
+# sorted, and texts in plain lists, so a question costs its two strings
+# and a few pointers. Each category has its own sorted array of ids.
+class Snapshot:
+
+    def __init__(self, rows, categories, version, local_version):
+        self.version = version
+        self.local_version = local_version
+        self.categories = categories
+        self.ids = array('q')
+        self.questions = []
+        self.answers = []
+        self.category_of = []
+        self.difficulties = []
+        self.by_category = {}
+        for id, question, answer, category, difficulty in rows:
+            self.ids.append(id)
+            self.questions.append(question)
+            self.answers.append(answer)
+            self.category_of.append(category)
+            self.difficulties.append(difficulty)
+            self.by_category.setdefault(category, array('q')).append(id)
+
+    def question_ids(self, category_id=None):
+        if category_id is None:
+            return self.ids
+        return self.by_category.get(category_id, array('q'))
+
+    def format(self, id):
+        i = bisect_left(self.ids, id)
+        return {
+            'id': id,
+            'question': self.questions[i],
+            'answer': self.answers[i],
+            'category': self.category_of[i],
+            'difficulty': self.difficulties[i]
+        }
+
+    def contains(self, ids, id):
+        i = bisect_left(ids, id)
+        return i < len(ids) and ids[i] == id
+
+    # Same pages as paginator() in app.py
+    def page(self, ids, page, after_id, page_size):
+        if after_id is not None:
+            start = bisect_right(ids, after_id)
+            rows = ids[start:start + page_size + 1]
+            page = None
+        else:
+            rows = []
+            if page > 1:
+                start = (page - 1) * page_size
+                rows = ids[start:start + page_size + 1]
+            if not rows:
+                page = 1
+                rows = ids[:page_size + 1]
+
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        next_after_id = rows[-1] if has_next else None
+
+        return [self.format(id) for id in rows], page, next_after_id
+
+    # Random question of the pool, skipping the previous questions, all
+    # eligible questions being equally likely: random positions are
+    # drawn until one is eligible, and when most of the pool was asked
+    # already, the remaining questions are listed instead
+    def random_question(self, ids, previous_questions):
+        for _ in range(RANDOM_DRAWS):
+            id = ids[random.randrange(len(ids))]
+            if id not in previous_questions:
+                return self.format(id)
+        previous_questions = set(previous_questions)
+        remaining = [id for id in ids if id not in previous_questions]
+        if not remaining:
+            return None
+        return self.format(random.choice(remaining))
+
+    def memory_bytes(self):
+        size = sum(sys.getsizeof(column) for column in (
+            self.ids, self.questions, self.answers, self.category_of,
+            self.difficulties, self.by_category, self.categories
+        ))
+        size += sum(sys.getsizeof(ids) for ids in self.by_category.values())
+        size += sum(sys.getsizeof(text) for text in self.questions)
+        size += sum(sys.getsizeof(text) for text in self.answers)
+        size += sum(sys.getsizeof(text) for text in self.categories.values())
+        return size
+
+
+# In-process read model
+# ---------------------------------------------------------------------
+# When QUESTION_SNAPSHOT is enabled, the question bank is loaded into
+# process memory and the read routes are served from it without any
+# query. A background thread polls the version counter of the database
+# every QUESTION_SNAPSHOT_POLL seconds and reloads the snapshot when it
+# changed, so changes made by other processes are picked up within
+# that delay. Writes of this process bump the data version and are
+# served from the database until the snapshot is reloaded, so a client
+# always reads its own writes.
+#
+# Each application has its own snapshot and poller thread, in
+# app.extensions.
+class QuestionSnapshot:
+
+    def init_app(self, app):
+        app.extensions['question_snapshot'] = SnapshotPoller(app)
+
+    def poller(self):
+        return current_app.extensions['question_snapshot']
+
+    def enabled(self):
+        return current_app.config.get('QUESTION_SNAPSHOT', False)
+
+    def get(self):
+        if not self.enabled():
+            return None
+        return self.poller().get()
+
+    def refresh(self, force=False):
+        return self.poller().refresh(force)
+
+    def stats(self):
+        return self.poller().stats()
+
+
+class SnapshotPoller:
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.wake = threading.Event()
+        self.reset()
+
+    def reset(self):
+        self.snapshot = None
+        self.pid = os.getpid()
+        self.poller = None
+        self.refreshes = 0
+        self.refresh_seconds = None
+        self.hits = 0
+        self.misses = 0
+
+    def enabled(self):
+        return self.app.config.get('QUESTION_SNAPSHOT', False)
+
+    # Current snapshot, or None if the database must be read
+    def get(self):
+        if self.pid != os.getpid():
+            # forked worker: the poller thread didn't survive the fork
+            self.reset()
+        self._start_poller()
+
+        snapshot = self.snapshot
+        if (snapshot is None or
+                snapshot.local_version != data_version.current()):
+            self.misses += 1
+            self.wake.set()
+            return None
+        self.hits += 1
+        return snapshot
+
+    # Reloads the snapshot if the database changed since it was taken.
+    # Returns whether it was reloaded.
+    def refresh(self, force=False):
+        with self.refresh_lock:
+            local_version = data_version.current()
+            with db.engine.connect() as connection:
+                version = connection.scalar(
+                                db.select(question_bank_version.c.version)
+                          )
+                snapshot = self.snapshot
+                if (not force and snapshot is not None and
+                        snapshot.version == version and
+                        snapshot.local_version == local_version):
+                    return False
+
+                start = time.perf_counter()
+                categories = dict(connection.execute(
+                                db.select(Category.id, Category.type)
+                             ).all())
+                rows = connection.execute(
+                            db.select(*QUESTION_COLUMNS).order_by(
+                                Question.id
+                            )
+                       )
+                self.snapshot = Snapshot(rows, categories, version,
+                                         local_version)
+                self.refresh_seconds = time.perf_counter() - start
+                self.refreshes += 1
+        return True
+
+    def _start_poller(self):
+        if self.poller is not None:
+            return
+        with self.lock:
+            if self.poller is not None:
+                return
+            self.poller = threading.Thread(target=self._poll_forever,
+                                           daemon=True)
+        self.poller.start()
+
+    def _poll_forever(self):
+        while self.enabled():
+            try:
+                with self.app.app_context():
+                    self.refresh()
+            except Exception:
+                print(sys.exc_info())
+            self.wake.wait(self.app.config.get('QUESTION_SNAPSHOT_POLL',
+                                               DEFAULT_POLL_INTERVAL))
+            self.wake.clear()
+        self.poller = None
+
+    def stats(self):
+        snapshot = self.snapshot
+        stats = {
+            'enabled': bool(self.enabled()),
+            'loaded': snapshot is not None,
+            'hits': self.hits,
+            'misses': self.misses,
+            'refreshes': self.refreshes,
+            'refresh_seconds': round(self.refresh_seconds, 6)
+            if self.refresh_seconds is not None else None,
+        }
+        if snapshot is not None:
+            stats.update({
+                'version': snapshot.version,
+                'questions': len(snapshot.ids),
+                'categories': len(snapshot.categories),
+                'memory_bytes': snapshot.memory_bytes(),
+            })
+        return stats
+
+
+question_snapshot = QuestionSnapshot()
@@ -0,0 +1,140 @@
+import time
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import Counter
+from flask import current_app
+from models import db, Question
+from migrations import question_bank_version
+from search import tokenize
+
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+# Prefixes whose completions are cached
+CACHE_SIZE = 4096
+# Seconds between two checks of the database for changes
+DEFAULT_POLL = 1.0
+
+
+# Prefix index of the question texts
+# ---------------------------------------------------------------------
+# Completions of a prefix are the tokens of the question texts starting
+# with it, ranked by the number of questions they appear in. Tokens are
+# kept in a sorted list, so the tokens starting with a prefix form a
+# range found by bisection, and the ranked completions of every prefix
+# asked for are cached: repeated keystrokes of a typeahead are dict
+# lookups. A write only drops the cached prefixes of the tokens of the
+# questions it adds or removes, and inserts or deletes tokens in the
+# sorted list without sorting it again.
+#
+# The index is built lazily on the first suggestion and kept up to date
+# by the write paths of this process, like the search index. Changes
+# made by other processes are picked up as the question snapshot does:
+# the version counter of the database is checked at most every
+# SUGGEST_INDEX_POLL seconds, and the index is rebuilt when it changed.
+# Writes of this process bump that counter too, so they are followed by
+# a rebuild as well, at most once per check.
+class SuggestIndex:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.ready = False
+        self.version = None
+        self.checked_at = 0
+        self.clear()
+
+    def clear(self):
+        self.tokens = []
+        self.frequencies = Counter()
+        self.documents = {}
+        self.cache = {}
+
+    def build(self, rows, version=None):
+        with self.lock:
+            self.clear()
+            for question_id, question in rows:
+                tokens = set(tokenize(question))
+                self.documents[question_id] = tokens
+                self.frequencies.update(tokens)
+            self.tokens = sorted(self.frequencies)
+            self.version = version
+            self.ready = True
+
+    # Builds the index, or rebuilds it if the database changed since it
+    # was built. Returns whether it was (re)built.
+    def refresh(self):
+        poll = current_app.config.get('SUGGEST_INDEX_POLL', DEFAULT_POLL)
+        if self.ready and time.monotonic() < self.checked_at + poll:
+            return False
+        with self.refresh_lock:
+            if self.ready and time.monotonic() < self.checked_at + poll:
+                return False
+            version = db.session.scalar(
+                            db.select(question_bank_version.c.version)
+                      )
+            self.checked_at = time.monotonic()
+            if self.ready and version == self.version:
+                return False
+            self.build(db.session.execute(self.index_statement()), version)
+        return True
+
+    def reset(self):
+        with self.lock:
+            self.ready = False
+            self.clear()
+
+    def add(self, question_id, question):
+        with self.lock:
+            if self.ready:
+                self._discard(question_id)
+                tokens = set(tokenize(question))
+                self.documents[question_id] = tokens
+                for token in tokens:
+                    if not self.frequencies[token]:
+                        insort(self.tokens, token)
+                    self.frequencies[token] += 1
+                    self._uncache(token)
+
+    def discard(self, question_id):
+        with self.lock:
+            if self.ready:
+                self._discard(question_id)
+
+    def _discard(self, question_id):
+        for token in self.documents.pop(question_id, ()):
+            self.frequencies[token] -= 1
+            if not self.frequencies[token]:
+                del self.frequencies[token]
+                del self.tokens[bisect_left(self.tokens, token)]
+            self._uncache(token)
+
+    def _uncache(self, token):
+        for end in range(1, len(token) + 1):
+            self.cache.pop(token[:end], None)
+
+    # Completions of prefix, most frequent first
+    def complete(self, prefix, limit=DEFAULT_LIMIT):
+        with self.lock:
+            completions = self.cache.get(prefix)
+            if completions is None:
+                start = bisect_left(self.tokens, prefix)
+                end = bisect_left(self.tokens, prefix[:-1] +
+                                  chr(ord(prefix[-1]) + 1))
+                completions = heapq.nsmallest(
+                    MAX_LIMIT, self.tokens[start:end],
+                    key=lambda token: (-self.frequencies[token], token)
+                )
+                if len(self.cache) >= CACHE_SIZE:
+                    self.cache.clear()
+                self.cache[prefix] = completions
+            return [
+                (token, self.frequencies[token])
+                for token in completions[:limit]
+            ]
+
+    def index_statement(self):
+        return db.select(Question.id, Question.question)
+
+
+suggest_index = SuggestIndex()
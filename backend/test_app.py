@@ -1,18 +1,43 @@
+import os
+import re
+import sys
+import gzip
 import json
+import decimal
+import datetime
+import dataclasses
+import random
 import uuid
+import tempfile
+import time
+import subprocess
 import unittest
-from models import db
+from models import db, Category, Question, insert_questions
+from migrations import migrate, MIGRATIONS
+from sqlalchemy import create_engine, event
+from starlette.testclient import TestClient
 from unittest import TestCase, mock
-from app import app, ITEMS_PER_PAGE
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from app import (
+    create_app, ITEMS_PER_PAGE, RANDOM_SCALE, select_random_question
+)
+from search import InvertedIndex, search_engine
+from cache import CategoryCache, DataVersion, category_cache
 from werkzeug.exceptions import InternalServerError
+from asgi import create_asgi_app
+from benchmark import generate_questions, measure_serialization
+from config import UnittestConfig
+from metrics import clear_metrics_dir, mark_process_dead
+from queries import query_tracker
+from json_provider import FastJSONProvider
+from flask.json.provider import DefaultJSONProvider
+from snapshot import Snapshot, question_snapshot
+from warmup import warmup
+from quiz_token import QuizProgress, MAX_SPAN, next_quiz_token
+from routing import replica_router
 
-app.config.from_object('config.UnittestConfig')
-
-db.app = app
-db.init_app(app)
-
-with app.app_context():
-    db.create_all()
+app = create_app('config.UnittestConfig')
 
 
 class TestTrivia(TestCase):
@@ -27,6 +52,324 @@ class TestTrivia(TestCase):
         self.assertEqual(data['success'], True)
         self.assertTrue(data['categories'])
 
+    def test_get_categories_question_counts(self):
+        data = json.loads(self.app.get('/categories').data)
+        counts = data['question_counts']
+        self.assertEqual(sum(counts.values()), data['total_questions'])
+
+        response = self.app.post('/questions', json={
+            'question': 'Test question',
+            'answer': 'Test answer',
+            'difficulty': 1,
+            'category': 2,
+        })
+        question_id = json.loads(response.data)['question_id']
+        data = json.loads(self.app.get('/categories').data)
+        self.assertEqual(data['question_counts']['2'], counts['2'] + 1)
+        self.assertEqual(data['total_questions'], sum(counts.values()) + 1)
+
+        self.app.delete(f'/questions/{question_id}')
+        data = json.loads(self.app.get('/categories').data)
+        self.assertEqual(data['question_counts'], counts)
+
+    def test_get_categories_cached(self):
+        self.app.get('/categories')
+        response = self.app.get('/categories/cache')
+        hits = json.loads(response.data)['cache']['hits']
+
+        self.app.get('/categories')
+        response = self.app.get('/categories/cache')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['cache']['hits'], hits + 1)
+
+    def test_get_categories_invalidated(self):
+        self.app.get('/categories')
+        test_category = 'test -' + uuid.uuid4().hex[:8]
+        self.app.post('/categories', json={'category': test_category})
+
+        response = self.app.get('/categories')
+        data = json.loads(response.data)
+        self.assertIn(test_category, data['categories'].values())
+
+    def test_get_questions_not_modified(self):
+        response = self.app.get('/questions', query_string={'page': 1})
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+
+        response = self.app.get('/questions', query_string={'page': 1},
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+    def test_get_categories_modified(self):
+        response = self.app.get('/categories')
+        etag = response.headers['ETag']
+
+        test_category = 'test -' + uuid.uuid4().hex[:8]
+        self.app.post('/categories', json={'category': test_category})
+
+        response = self.app.get('/categories',
+                                headers={'If-None-Match': etag})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn(test_category, data['categories'].values())
+
+    def test_get_questions_modified_by_other_process(self):
+        response = self.app.get('/questions', query_string={'page': 1})
+        etag = response.headers['ETag']
+        total = json.loads(response.data)['total_questions']
+
+        # written without going through the app, like another worker
+        with app.app_context(), db.engine.begin() as connection:
+            question_id = connection.execute(
+                db.insert(Question).values(
+                    question='Test question', answer='Test answer',
+                    difficulty=1, category=1
+                ).returning(Question.id)
+            ).scalar_one()
+
+        response = self.app.get('/questions', query_string={'page': 1},
+                                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(json.loads(response.data)['total_questions'],
+                         total + 1)
+        self.app.delete(f'/questions/{question_id}')
+
+    def test_get_categories_modified_by_other_process(self):
+        response = self.app.get('/categories')
+        etag = response.headers['ETag']
+        type = json.loads(response.data)['categories']['1']
+
+        # the category map cached by this worker is older than the ETag
+        with app.app_context(), db.engine.begin() as connection:
+            connection.execute(db.update(Category).where(
+                Category.id == 1
+            ).values(type='Renamed'))
+        try:
+            response = self.app.get('/categories',
+                                    headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                json.loads(response.data)['categories']['1'], 'Renamed'
+            )
+        finally:
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(db.update(Category).where(
+                    Category.id == 1
+                ).values(type=type))
+
+    def test_get_pool_stats(self):
+        self.app.get('/categories')
+        response = self.app.get('/health/pool')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['pool']['pool'], 'InstrumentedQueuePool')
+        self.assertTrue(data['pool']['checkouts'] > 0)
+        self.assertEqual(data['pool']['checked_out'], 0)
+
+    def test_get_metrics(self):
+        self.app.get('/categories')
+        response = self.app.get('/metrics')
+        text = response.data.decode()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_request_duration_seconds_count{'
+                      'endpoint="get_categories",method="GET",status="200"}',
+                      text)
+        self.assertIn('http_response_size_bytes_bucket{', text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+    def test_get_metrics_multiprocess(self):
+        exited = subprocess.Popen([sys.executable, '-c', ''])
+        exited.wait()
+        with tempfile.TemporaryDirectory() as directory:
+            # snapshot left by a worker process that has exited
+            with open(os.path.join(directory, 'metrics-0.json'), 'w') as f:
+                json.dump({
+                    'pid': exited.pid,
+                    'in_flight': 3,
+                    'histograms': {
+                        'http_request_duration_seconds': [[
+                            ['test_endpoint', 'GET', '200'],
+                            {'buckets': [1] + [0] * 12,
+                             'sum': 0.0005, 'count': 1}
+                        ]],
+                    },
+                }, f)
+
+            with mock.patch.dict(app.config, {'METRICS_DIR': directory}):
+                response = self.app.get('/metrics')
+        text = response.data.decode()
+        self.assertIn('http_request_duration_seconds_count{'
+                      'endpoint="test_endpoint",method="GET",status="200"} 1',
+                      text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+    def test_metrics_of_exited_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for pid in (101, 102):
+                path = os.path.join(directory, f'metrics-{pid}.json')
+                with open(path, 'w') as f:
+                    json.dump({
+                        'pid': pid,
+                        'in_flight': 1,
+                        'histograms': {
+                            'http_request_duration_seconds': [[
+                                ['test_endpoint', 'GET', '200'],
+                                {'buckets': [1] + [0] * 12,
+                                 'sum': 0.0005, 'count': 1}
+                            ]],
+                        },
+                    }, f)
+                mark_process_dead(pid, directory)
+            files = os.listdir(directory)
+
+            with mock.patch.dict(app.config, {'METRICS_DIR': directory}):
+                response = self.app.get('/metrics')
+            clear_metrics_dir(directory)
+            self.assertEqual(os.listdir(directory), [])
+        self.assertEqual(files, ['metrics-dead.json'])
+        text = response.data.decode()
+        self.assertIn('http_request_duration_seconds_count{'
+                      'endpoint="test_endpoint",method="GET",status="200"} 2',
+                      text)
+        self.assertIn('http_requests_in_flight 1', text)
+
+    def test_server_timing(self):
+        response = self.app.get('/questions', query_string={'page': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response.headers['Server-Timing'],
+                         r'^db;dur=[0-9.]+;desc="3 queries"$')
+
+    def test_repeated_queries(self):
+        with app.test_request_context('/questions'):
+            with self.assertLogs(app.logger, 'WARNING') as logs:
+                for _ in range(3):
+                    db.session.execute(
+                        db.select(Category).where(Category.id == 1)
+                    )
+                response = query_tracker.after_request(
+                                app.response_class()
+                           )
+        self.assertEqual(response.headers['X-Repeated-Queries'], '1')
+        self.assertIn('run 3 times in GET /questions', logs.output[0])
+
+    def test_check_indexes(self):
+        result = app.test_cli_runner().invoke(args=['check-indexes'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('ok        category by name (ix_categories_type_lower)',
+                      result.output)
+        self.assertNotIn('NO INDEX', result.output)
+
+    def test_liveness(self):
+        response = self.app.get('/health/live')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['live'], True)
+
+    def test_readiness_after_warmup(self):
+        with mock.patch.dict(app.config, {'WARMUP': True}):
+            warmup.reset(app)
+            try:
+                response = self.app.get('/health/ready')
+                if response.status_code != 200:
+                    self.assertEqual(response.status_code, 503)
+                    self.assertTrue(warmup.state(app).ready.wait(10))
+                    response = self.app.get('/health/ready')
+            finally:
+                warmup.reset(app)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['warmup']['error'], None)
+        self.assertEqual(data['warmup']['failed'], [])
+        with app.app_context():
+            self.assertEqual(data['warmup']['connections'],
+                             db.engine.pool.size())
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_forked_worker_has_own_pool(self):
+        with app.app_context():
+            engine = db.engine
+            db.session.execute(db.select(Category.id)).all()
+            db.session.remove()
+        self.assertGreater(engine.pool.checkedin(), 0)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if engine.pool.checkedin() == 0 else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertGreater(engine.pool.checkedin(), 0)
+
+    def test_read_replicas(self):
+        with tempfile.TemporaryDirectory() as directory:
+            replica_uri = f'sqlite:///{directory}/replica.db'
+            # fails to connect: its directory doesn't exist
+            missing_uri = f'sqlite:///{directory}/missing/replica.db'
+            engine = create_engine(replica_uri)
+            db.metadata.create_all(engine)
+            migrate(engine)
+            with engine.begin() as connection:
+                connection.execute(
+                    db.insert(Category).values(id=1, type='Replica')
+                )
+            engine.dispose()
+
+            category_cache.invalidate()
+            with mock.patch.dict(app.config, {
+                'DB_REPLICA_URIS': [missing_uri, replica_uri],
+                'READ_YOUR_WRITES_SECONDS': 60,
+            }):
+                for _ in range(2):
+                    data = json.loads(self.app.get('/categories').data)
+                    self.assertEqual(data['question_counts'], {'1': 0})
+                    # the category map is cached from the primary only
+                    self.assertNotEqual(data['categories'],
+                                        {'1': 'Replica'})
+                stats = json.loads(self.app.get('/health/replicas').data)
+
+                # the client reads its own write from the primary
+                response = self.app.post('/categories', json={
+                    'category': 'test -' + uuid.uuid4().hex[:8]
+                })
+                category_id = json.loads(response.data)['category_id']
+                self.assertIn('read_primary_until',
+                              response.headers['Set-Cookie'])
+                # even after another client read from the lagging replica
+                other = json.loads(app.test_client().get('/categories').data)
+                data = json.loads(self.app.get('/categories').data)
+                self.app.delete(f'/categories/{category_id}')
+
+            category_cache.invalidate()
+            for uri in (replica_uri, missing_uri):
+                replica_router.engines.pop(uri).dispose()
+            replica_router.reset()
+
+        self.assertIn(str(category_id), other['categories'])
+        self.assertIn(str(category_id), data['categories'])
+        self.assertEqual(
+            [(replica['failures'], replica['down'], replica['reads'])
+             for replica in stats['replicas']],
+            [(1, True, 0), (0, False, 2)]
+        )
+
+    def test_add_category_duplicate_race(self):
+        with app.app_context(), \
+                mock.patch.object(Category, 'query') as mock_query:
+            # the duplicate check doesn't see the existing category
+            mock_query.filter.return_value.one_or_none.return_value = None
+            response = self.app.post('/categories',
+                                     json={'category': 'SCIENCE'})
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertIn('already exists', data['message'])
+
     def test_get_questions(self):
         response = self.app.get('/questions', query_string={'page': 1})
         data = json.loads(response.data)
@@ -35,6 +378,29 @@ class TestTrivia(TestCase):
         self.assertTrue(data['questions'])
         self.assertEqual(len(data['questions']), ITEMS_PER_PAGE)
 
+    def test_get_questions_out_of_range_page(self):
+        response = self.app.get('/questions', query_string={'page': 1000})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actual_page'], 1)
+        self.assertEqual(len(data['questions']), ITEMS_PER_PAGE)
+
+    def test_get_questions_keyset(self):
+        response = self.app.get('/questions', query_string={'page': 1})
+        first_page = json.loads(response.data)
+        after_id = first_page['next_after_id']
+        self.assertEqual(after_id, first_page['questions'][-1]['id'])
+
+        response = self.app.get('/questions',
+                                query_string={'after_id': after_id})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['questions'])
+        self.assertTrue(all(q['id'] > after_id for q in data['questions']))
+        self.assertEqual(data['total_questions'],
+                         first_page['total_questions'])
+
     def test_get_questions_by_category(self):
         response = self.app.get('/categories/1/questions')
         data = json.loads(response.data)
@@ -56,6 +422,92 @@ class TestTrivia(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_add_new_question_group_commit(self):
+        texts = ['test -' + uuid.uuid4().hex for _ in range(8)]
+
+        def add(text):
+            response = app.test_client().post('/questions', json={
+                'question': text,
+                'answer': 'test',
+                'difficulty': 1,
+                'category': 1,
+            })
+            return json.loads(response.data)['question_id']
+
+        with mock.patch.dict(app.config, {'GROUP_COMMIT': True,
+                                          'GROUP_COMMIT_MAX_DELAY_MS': 200}):
+            with ThreadPoolExecutor(len(texts)) as executor:
+                question_ids = list(executor.map(add, texts))
+
+        with app.app_context():
+            for question_id, text in zip(question_ids, texts):
+                self.assertEqual(
+                    db.session.get(Question, question_id).question, text
+                )
+        text = self.app.get('/metrics').data.decode()
+        count = re.search(r'^group_commit_batch_size_count (\S+)$', text,
+                          re.M)
+        total = re.search(r'^group_commit_batch_size_sum (\S+)$', text,
+                          re.M)
+        # fewer commits than questions
+        self.assertLess(float(count.group(1)), float(total.group(1)))
+        self.assertIn('group_commit_flush_seconds_bucket{le="+Inf"}', text)
+
+    def test_suggest_search_terms(self):
+        self.app.get('/questions/suggest', query_string={'q': 'w'})
+        response = self.app.get('/questions/suggest',
+                                query_string={'q': 'Who wh', 'limit': 3})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('desc="0 queries"', response.headers['Server-Timing'])
+        self.assertTrue(0 < len(data['suggestions']) <= 3)
+        counts = [s['questions'] for s in data['suggestions']]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        for suggestion in data['suggestions']:
+            self.assertTrue(suggestion['term'].startswith('who wh'))
+
+        response = self.app.get('/questions/suggest',
+                                query_string={'q': 'who', 'limit': 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_suggest_search_terms_updated(self):
+        self.app.get('/questions/suggest', query_string={'q': 'w'})
+        word = 'qx' + uuid.uuid4().hex[:8]
+        response = self.app.post('/questions', json={
+            'question': f'Test {word}?',
+            'answer': 'Test answer',
+            'difficulty': 1,
+            'category': 2,
+        })
+        question_id = json.loads(response.data)['question_id']
+        response = self.app.get('/questions/suggest',
+                                query_string={'q': word[:6]})
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         [{'term': word, 'questions': 1}])
+
+        self.app.delete(f'/questions/{question_id}')
+        response = self.app.get('/questions/suggest',
+                                query_string={'q': word[:6]})
+        self.assertEqual(json.loads(response.data)['suggestions'], [])
+
+    def test_suggest_search_terms_modified_by_other_process(self):
+        self.app.get('/questions/suggest', query_string={'q': 'w'})
+        word = 'qx' + uuid.uuid4().hex[:8]
+        with app.app_context(), db.engine.begin() as connection:
+            question_id = connection.execute(
+                db.insert(Question).values(
+                    question=f'Test {word}?', answer='Test answer',
+                    difficulty=1, category=2
+                ).returning(Question.id)
+            ).scalar_one()
+
+        with mock.patch.dict(app.config, {'SUGGEST_INDEX_POLL': 0}):
+            response = self.app.get('/questions/suggest',
+                                    query_string={'q': word[:6]})
+        self.app.delete(f'/questions/{question_id}')
+        self.assertEqual(json.loads(response.data)['suggestions'],
+                         [{'term': word, 'questions': 1}])
+
     def test_question_search(self):
         # search for the previously added test question
         response = self.app.post('/questions',
@@ -69,6 +521,62 @@ class TestTrivia(TestCase):
         self.assertTrue(data['questions'])
         self.assertTrue(len(data['questions']) > 0)
 
+    def test_question_search_answer(self):
+        # answers are searched as well as questions
+        response = self.app.post('/questions',
+                                 json={
+                                   'search_term': 'scarab',
+                                 })
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIn('Scarab', [q['answer'] for q in data['questions']])
+
+    def test_question_search_paginated(self):
+        for _ in range(ITEMS_PER_PAGE + 1):
+            self.app.post('/questions',
+                          json={
+                            'question': 'paged -' + uuid.uuid4().hex,
+                            'answer': 'test',
+                            'difficulty': 1,
+                            'category': 1,
+                          })
+
+        response = self.app.post('/questions',
+                                 json={
+                                   'search_term': 'paged',
+                                   'page': 2,
+                                 })
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actual_page'], 2)
+        self.assertTrue(data['questions'])
+        self.assertTrue(len(data['questions']) <= ITEMS_PER_PAGE)
+        self.assertTrue(data['total_questions'] > ITEMS_PER_PAGE)
+
+    def test_question_search_page_below_first(self):
+        for _ in range(ITEMS_PER_PAGE + 1):
+            self.app.post('/questions',
+                          json={
+                            'question': 'below -' + uuid.uuid4().hex,
+                            'answer': 'test',
+                            'difficulty': 1,
+                            'category': 1,
+                          })
+
+        response = self.app.post('/questions',
+                                 json={
+                                   'search_term': 'below',
+                                   'page': -1,
+                                 })
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actual_page'], 1)
+        self.assertEqual(len(data['questions']), ITEMS_PER_PAGE)
+
     def test_delete_question(self):
         # add a new test question to be deleted
         test_question = 'test -' + uuid.uuid4().hex
@@ -90,6 +598,237 @@ class TestTrivia(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_bulk_import_questions(self):
+        rows = [
+            json.dumps({
+                'question': 'bulk -' + uuid.uuid4().hex,
+                'answer': 'test',
+                'difficulty': 1,
+                'category': 1,
+            })
+            for _ in range(3)
+        ]
+        rows.append(json.dumps({'question': 'test', 'category': 1}))
+        response = self.app.post('/questions/bulk',
+                                 query_string={'batch_size': 2},
+                                 data='\n'.join(rows),
+                                 content_type='application/x-ndjson')
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['imported'], 3)
+        self.assertEqual(data['rejected'], 1)
+        self.assertEqual(data['batches'], 2)
+        self.assertEqual(data['errors'][0]['batch'], 2)
+        self.assertEqual(data['errors'][0]['errors'][0]['line'], 4)
+
+    def test_bulk_import_questions_csv(self):
+        rows = 'question,answer,difficulty,category\n' \
+               f'bulk -{uuid.uuid4().hex},test,1,1\n' \
+               f'bulk -{uuid.uuid4().hex},test,1,1000\n'
+        response = self.app.post('/questions/bulk', data=rows,
+                                 content_type='text/csv')
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['imported'], 1)
+        self.assertEqual(data['errors'][0]['errors'][0]['message'],
+                         'Category not found')
+
+    def test_import_questions_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl',
+                                         delete=False) as file:
+            file.write(json.dumps({
+                'question': 'bulk -' + uuid.uuid4().hex,
+                'answer': 'test',
+                'difficulty': 1,
+                'category': 1,
+            }))
+
+        try:
+            result = app.test_cli_runner().invoke(
+                        args=['import-questions', file.name]
+                     )
+        finally:
+            os.remove(file.name)
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('1 questions imported', result.output)
+
+    def test_export_questions(self):
+        response = self.app.get('/questions/export',
+                                query_string={'category': 2})
+        questions = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertTrue(questions)
+        self.assertTrue(all(q['category'] == 2 for q in questions))
+
+    def test_export_questions_gzip(self):
+        response = self.app.get('/questions/export',
+                                query_string={'gzip': 'true'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(response.data).splitlines()
+        self.assertTrue(all(json.loads(line)['id'] for line in lines))
+
+    def test_batch_questions(self):
+        test_question = {
+            'question': 'batch -' + uuid.uuid4().hex,
+            'answer': 'test',
+            'difficulty': 1,
+            'category': 1,
+        }
+        response = self.app.post('/questions/batch',
+                                 json={
+                                   'questions': [
+                                     test_question,
+                                     {'question': 'test'},
+                                     {**test_question, 'category': 1000},
+                                     test_question,
+                                   ]
+                                 })
+
+        data = json.loads(response.data)
+        results = data['results']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([r['success'] for r in results],
+                         [True, False, False, True])
+        self.assertEqual(results[1]['error'], 400)
+        self.assertEqual(results[2]['error'], 404)
+        question_ids = [results[0]['question_id'], results[3]['question_id']]
+        self.assertTrue(question_ids[0] < question_ids[1])
+
+        # delete both test questions and a missing one
+        response = self.app.post('/questions/batch-delete',
+                                 json={'ids': question_ids + [100000]})
+        data = json.loads(response.data)
+        results = data['results']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['success'] for r in results],
+                         [True, True, False])
+        self.assertEqual(results[2]['error'], 404)
+
+    def test_insert_questions_ids_out_of_order(self):
+        rows = [
+            {'question': 'a', 'answer': 'a', 'difficulty': 1, 'category': 1},
+            {'question': 'b', 'answer': 'b', 'difficulty': 1, 'category': 1},
+            {'question': 'a', 'answer': 'a', 'difficulty': 1, 'category': 1},
+            {'question': 5, 'answer': 'c', 'difficulty': 1, 'category': 1},
+        ]
+        connection = mock.Mock()
+        # returned in any order, with the values stored by the database
+        connection.execute.return_value = [
+            (14, '5', 'c', 1, 1),
+            (13, 'a', 'a', 1, 1),
+            (12, 'b', 'b', 1, 1),
+            (11, 'a', 'a', 1, 1),
+        ]
+        self.assertEqual(insert_questions(connection, rows),
+                         [11, 12, 13, 14])
+
+    def test_multi_call_batch(self):
+        question = 'batch -' + uuid.uuid4().hex
+        response = self.app.post('/batch', json={'requests': [
+            {'path': '/questions?page=1'},
+            {'path': '/categories'},
+            {'method': 'POST', 'path': '/questions', 'body': {
+                'question': question,
+                'answer': 'test',
+                'difficulty': 1,
+                'category': 1,
+            }},
+            # runs after the write
+            {'method': 'POST', 'path': '/questions',
+             'body': {'search_term': question}},
+            {'path': '/categories/1000/questions'},
+            {'method': 'PUT', 'path': '/categories'},
+            {'path': '/batch'},
+            {'method': 'POST', 'path': '/%62atch',
+             'body': {'requests': [{'path': '/categories'}]}},
+        ]})
+
+        data = json.loads(response.data)
+        responses = data['responses']
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual([r['status'] for r in responses],
+                         [200, 200, 200, 200, 404, 400, 405, 400])
+        self.assertEqual(
+            responses[0]['body']['questions'],
+            json.loads(self.app.get('/questions?page=1').data)['questions']
+        )
+        self.assertTrue(responses[1]['body']['categories'])
+        question_id = responses[2]['body']['question_id']
+        self.assertEqual(
+            [q['id'] for q in responses[3]['body']['questions']],
+            [question_id]
+        )
+        self.assertEqual(responses[7]['body']['message'],
+                         'Nested batches are not allowed')
+
+        self.app.delete(f'/questions/{question_id}')
+
+    def test_multi_call_batch_read_your_writes(self):
+        with mock.patch.dict(app.config, {'READ_YOUR_WRITES_SECONDS': 60}):
+            response = self.app.post('/batch', json={'requests': [
+                {'path': '/categories'},
+                {'path': '/questions'},
+            ]})
+            self.assertNotIn('Set-Cookie', response.headers)
+
+            # the cookie of a write in the batch is passed on
+            response = self.app.post('/batch', json={'requests': [
+                {'method': 'POST', 'path': '/categories',
+                 'body': {'category': 'test -' + uuid.uuid4().hex[:8]}},
+            ]})
+            self.assertIn('read_primary_until', response.headers['Set-Cookie'])
+            category_id = json.loads(response.data)[
+                            'responses'][0]['body']['category_id']
+            self.app.delete(f'/categories/{category_id}')
+
+    def test_multi_call_batch_two_apps(self):
+        with tempfile.TemporaryDirectory() as directory:
+            other = create_app(type('OtherConfig', (UnittestConfig,), {
+                'SQLALCHEMY_DATABASE_URI': f'sqlite:///{directory}/other.db'
+            }))
+            with other.app_context():
+                db.session.add(Category('Other'))
+                db.session.commit()
+                engines = list(db.engines.values())
+
+            # each app dispatches the batch to itself
+            body = {'requests': [{'path': '/categories/1/questions'},
+                                 {'path': '/categories/1/questions'}]}
+            responses = [
+                json.loads(client.post('/batch', json=body).data)
+                for client in (self.app, other.test_client())
+            ]
+            for engine in engines:
+                engine.dispose()
+
+        self.assertEqual(
+            [[r['body']['current_category'] for r in data['responses']]
+             for data in responses],
+            [['Science', 'Science'], ['Other', 'Other']]
+        )
+
+    def test_multi_call_batch_invalid(self):
+        response = self.app.post('/batch', json={'requests': []})
+        self.assertEqual(response.status_code, 400)
+
+        with mock.patch('app.count_questions', side_effect=Exception):
+            response = self.app.post('/batch', json={'requests': [
+                {'path': '/categories'},
+                {'path': '/categories', 'method': 'GET'},
+            ]})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([r['status'] for r in data['responses']],
+                         [500, 500])
+        self.assertEqual(data['responses'][0]['body']['success'], False)
+
     def test_add_new_category(self):
         test_category = 'test -' + uuid.uuid4().hex[:8]
         response = self.app.post('/categories', json={
@@ -118,6 +857,28 @@ class TestTrivia(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(data['success'], True)
 
+    def test_delete_category_with_questions(self):
+        test_category = 'test -' + uuid.uuid4().hex[:8]
+        response = self.app.post('/categories',
+                                 json={'category': test_category})
+        category_id = json.loads(response.data)['category_id']
+        self.app.post('/questions/batch', json={'questions': [{
+            'question': f'Question {i}',
+            'answer': 'Answer',
+            'difficulty': 1,
+            'category': category_id,
+        } for i in range(5)]})
+
+        response = self.app.delete(f'/categories/{category_id}')
+        self.assertEqual(response.status_code, 200)
+        # the category is read, then deleted with its questions by the
+        # database: the questions are never loaded
+        self.assertIn('desc="2 queries"', response.headers['Server-Timing'])
+        with app.app_context():
+            self.assertEqual(Question.query.filter(
+                                Question.category == category_id
+                             ).count(), 0)
+
     def test_get_quizz_question(self):
         prev_questions = [16, 18]
         response = self.app.post('/quizzes',
@@ -148,23 +909,160 @@ class TestTrivia(TestCase):
         self.assertTrue(data['question'])
         self.assertNotIn(data['question']['id'], prev_questions)
 
+    def test_get_quizz_question_token(self):
+        response = self.app.get('/categories/2/questions')
+        question_ids = {q['id'] for q in json.loads(response.data)[
+                                                'questions']}
+        asked = []
+        body = {'quiz_category': {'id': 2}, 'previous_questions': []}
+        while True:
+            response = self.app.post('/quizzes', json=body)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertLess(len(data['quiz_token']), 100)
+            if data['question'] is None:
+                break
+            asked.append(data['question']['id'])
+            body = {'quiz_category': {'id': 2},
+                    'quiz_token': data['quiz_token']}
+        self.assertEqual(sorted(asked), sorted(question_ids))
+
+    def test_get_quizz_question_token_not_listed(self):
+        with app.app_context():
+            question_ids = list(db.session.scalars(
+                db.select(Question.id).order_by(Question.id)
+            ))
+            engine = db.engine
+        asked = question_ids[::2]
+        quiz_token = next_quiz_token(0, asked, None, app.config['SECRET_KEY'])
+
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+
+        event.listen(engine, 'before_cursor_execute', record)
+        try:
+            with mock.patch('app.random', random.Random(0)):
+                response = self.app.post('/quizzes', json={
+                                            'quiz_category': {'id': 0},
+                                            'quiz_token': quiz_token
+                                         })
+        finally:
+            event.remove(engine, 'before_cursor_execute', record)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(data['question']['id'], asked)
+        # the asked questions are left out without being sent
+        self.assertFalse([s for s in statements if 'NOT IN' in s])
+
+    def test_get_quizz_question_token_invalid(self):
+        response = self.app.post('/quizzes', json={
+                                    'quiz_category': {'id': 2},
+                                    'previous_questions': [16]
+                                 })
+        quiz_token = json.loads(response.data)['quiz_token']
+        # token of another category
+        response = self.app.post('/quizzes', json={
+                                    'quiz_category': {'id': 1},
+                                    'quiz_token': quiz_token
+                                 })
+        self.assertEqual(response.status_code, 400)
+        # tampered token
+        payload, signature = quiz_token.rsplit('.', 1)
+        response = self.app.post('/quizzes', json={
+                                    'quiz_category': {'id': 2},
+                                    'quiz_token': payload + 'A.' + signature
+                                 })
+        self.assertEqual(response.status_code, 400)
+        # the list of previous questions is used instead
+        response = self.app.post('/quizzes', json={
+                                    'quiz_category': {'id': 2},
+                                    'quiz_token': payload + 'A.' + signature,
+                                    'previous_questions': [16]
+                                 })
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(data['question']['id'], 16)
+
+    def test_get_quizz_question_uniform(self):
+        with app.app_context():
+            question_ids = list(db.session.scalars(
+                db.select(Question.id).where(
+                    Question.category == 1
+                ).order_by(Question.id)
+            ))
+        # the questions right after the previous ones get no extra chance
+        previous, eligible = question_ids[:1], question_ids[1:]
+        draws = [-(-i * RANDOM_SCALE // len(eligible))
+                 for i in range(len(eligible))]
+
+        asked = []
+        # picked by rank when no drawn id is eligible
+        with mock.patch('app.random.randrange', side_effect=draws), \
+                mock.patch('app.RANDOM_ID_DRAWS', 0):
+            for _ in draws:
+                response = self.app.post('/quizzes', json={
+                                            'quiz_category': {'id': 1},
+                                            'previous_questions': previous
+                                         })
+                asked.append(json.loads(response.data)['question']['id'])
+        self.assertEqual(asked, eligible)
+
+    def test_get_quizz_question_drawn_uniform(self):
+        pool = [Question.category == 2]
+        with app.app_context():
+            question_ids = list(db.session.scalars(
+                db.select(Question.id).where(*pool)
+            ))
+            previous = set(question_ids[:1])
+            with mock.patch('app.random', random.Random(0)), \
+                    mock.patch.object(db.session, 'execute',
+                                      wraps=db.session.execute) as execute:
+                counts = Counter(
+                    select_random_question(pool, previous).id
+                    for _ in range(600)
+                )
+        self.assertEqual(set(counts), set(question_ids) - previous)
+        expected = sum(counts.values()) / len(counts)
+        self.assertTrue(all(abs(count - expected) < expected * 0.2
+                            for count in counts.values()), counts)
+        # the range and the drawn ids, without falling back to the rank
+        self.assertEqual(execute.call_count, 2 * sum(counts.values()))
+
+    def test_get_quizz_question_exhausted(self):
+        response = self.app.get('/categories/2/questions')
+        prev_questions = [q['id'] for q in json.loads(response.data)[
+                                                'questions']]
+        response = self.app.post('/quizzes',
+                                 json={
+                                  'quiz_category': {'id': 2, 'type': 'Art'},
+                                  'previous_questions': prev_questions
+                                  }
+                                 )
+
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertIsNone(data['question'])
+
     # Failure tests
     # -----------------------------------------------------------------
     @mock.patch('app.Category')
     def test_get_categories_fail(self, mock_model):
         # Mocking an internal server error
         mock_model.query.all.side_effect = InternalServerError('Mock error')
+        category_cache.invalidate()
 
         response = self.app.get('/categories')
         data = json.loads(response.data)
         self.assertEqual(response.status_code, 500)
         self.assertEqual(data['success'], False)
 
-    @mock.patch('app.Question')
-    def test_get_questions_fail(self, mock_model):
+    @mock.patch('app.db.session')
+    def test_get_questions_fail(self, mock_session):
         # Mocking an internal server error
-        mock_model.query.order_by.return_value.all.side_effect =\
-                   InternalServerError('Mock error')
+        mock_session.execute.side_effect = InternalServerError('Mock error')
 
         response = self.app.get('/questions', query_string={'page': 1})
         data = json.loads(response.data)
@@ -195,10 +1093,10 @@ class TestTrivia(TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(data['success'], False)
 
-    @mock.patch('app.Question')
-    def test_question_search_fail(self, mock_model):
+    @mock.patch('app.db.session')
+    def test_question_search_fail(self, mock_session):
         # Mocking an internal server error
-        mock_model.query.filter.side_effect = InternalServerError('Mock error')
+        mock_session.execute.side_effect = InternalServerError('Mock error')
 
         response = self.app.post('/questions',
                                  json={
@@ -209,6 +1107,30 @@ class TestTrivia(TestCase):
         self.assertEqual(response.status_code, 500)
         self.assertEqual(data['success'], False)
 
+    def test_export_questions_fail(self):
+        # category_id is out of range
+        response = self.app.get('/questions/export',
+                                query_string={'category': 1000})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(data['success'], False)
+
+    @mock.patch('app.db.session')
+    def test_batch_questions_fail(self, mock_session):
+        # Mocking an internal server error
+        mock_session.commit.side_effect = InternalServerError('Mock error')
+
+        response = self.app.post('/questions/batch-delete',
+                                 json={'ids': [16]})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['results'][0]['error'], 500)
+
+        # an empty batch is invalid
+        response = self.app.post('/questions/batch', json={'questions': []})
+        self.assertEqual(response.status_code, 400)
+
     def test_delete_question_fail(self):
         # question id out of range
         response = self.app.delete('/questions/1000')
@@ -258,5 +1180,445 @@ class TestTrivia(TestCase):
         self.assertEqual(data['success'], False)
 
 
+class TestQuestionSnapshot(TestCase):
+
+    def setUp(self):
+        self.app = app.test_client()
+        self.enabled = mock.patch.dict(app.config, {
+            'QUESTION_SNAPSHOT': True,
+            'QUESTION_SNAPSHOT_POLL': 60,
+        })
+
+    def refresh(self):
+        with app.app_context():
+            return question_snapshot.refresh()
+
+    def test_pages_match_database(self):
+        paths = [
+            '/questions?page=2',
+            '/questions?page=1000',
+            '/questions?after_id=10',
+            '/categories/1/questions',
+            '/categories/4/questions?after_id=5',
+        ]
+        expected = [self.app.get(path).get_json() for path in paths]
+
+        with self.enabled:
+            self.refresh()
+            responses = [self.app.get(path) for path in paths]
+            response = self.app.get('/categories/1000/questions')
+        self.assertEqual(response.status_code, 404)
+        for response, data in zip(responses, expected):
+            self.assertEqual(response.get_json(), data)
+            self.assertIn('desc="0 queries"',
+                          response.headers['Server-Timing'])
+
+    def test_get_next_question(self):
+        with app.app_context():
+            question_ids = db.session.execute(
+                            db.select(Question.id).where(
+                                Question.category == 1
+                            )
+                           ).scalars().all()
+
+        with self.enabled:
+            self.refresh()
+            response = self.app.post('/quizzes', json={
+                'quiz_category': {'id': 1},
+                'previous_questions': question_ids[1:],
+            })
+            invalid = self.app.post('/quizzes', json={
+                'quiz_category': {'id': 2},
+                'previous_questions': question_ids[:1],
+            })
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['question']['id'],
+                         question_ids[0])
+        self.assertIn('desc="0 queries"', response.headers['Server-Timing'])
+        self.assertEqual(invalid.status_code, 400)
+
+    def test_random_question_uniform(self):
+        snapshot = Snapshot(
+            [(id, 'question', 'answer', 1, 1) for id in range(1, 31)],
+            {1: 'Science'}, 0, 0
+        )
+        ids = snapshot.question_ids()
+        for previous_questions in (set(range(1, 21)), set(range(1, 29))):
+            rng = random.Random(0)
+            with mock.patch('snapshot.random', rng):
+                counts = Counter(
+                    snapshot.random_question(ids, previous_questions)['id']
+                    for _ in range(3000)
+                )
+            self.assertEqual(set(counts), set(ids) - previous_questions)
+            expected = 3000 / len(counts)
+            self.assertTrue(all(abs(count - expected) < expected * 0.2
+                                for count in counts.values()), counts)
+
+    def test_random_question_deleted_previous(self):
+        snapshot = Snapshot(
+            [(id, 'question', 'answer', 1, 1) for id in range(1, 4)],
+            {1: 'Science'}, 0, 0
+        )
+        # questions asked before being deleted don't count as asked
+        question = snapshot.random_question(snapshot.question_ids(),
+                                            {1, 2, 10, 11})
+        self.assertEqual(question['id'], 3)
+
+    def test_refresh_on_version_change(self):
+        with self.enabled:
+            self.refresh()
+            self.assertFalse(self.refresh())
+
+            # written by another process: bumps the database version
+            with app.app_context(), db.engine.begin() as connection:
+                connection.execute(db.insert(Question).values(
+                    question='Snapshot?', answer='Yes', difficulty=1,
+                    category=1
+                ))
+            self.assertTrue(self.refresh())
+            question_id = max(
+                app.extensions['question_snapshot'].snapshot.ids
+            )
+            data = self.app.get('/questions/snapshot').get_json()
+
+            # written by this process: never served from an older snapshot
+            self.app.delete(f'/questions/{question_id}')
+            response = self.app.get('/questions',
+                                    query_string={'after_id': question_id - 1})
+
+        self.assertEqual(response.get_json()['questions'], [])
+        self.assertTrue(data['snapshot']['loaded'])
+        self.assertTrue(data['snapshot']['memory_bytes'] > 0)
+        self.assertIsNotNone(data['snapshot']['refresh_seconds'])
+
+
+class TestJSONProvider(TestCase):
+
+    @dataclasses.dataclass
+    class Row:
+        id: int
+        created: datetime.date
+
+    def test_same_bytes_as_json_module(self):
+        provider = FastJSONProvider(app)
+        flask_provider = DefaultJSONProvider(app)
+        values = [
+            {'questions': [{'id': 1, 'question': 'Où?', 'answer': None}]},
+            {'categories': {1: 'Art', 2: 'Science'}, 'total': 2},
+            {'categories': {9: 'Art', 10: 'Science'}},
+            {'categories': {}, 'questions': [{'id': 1, 'answer': 'a'}]},
+            {'seconds': 1e-07, 'rows_per_second': 1.5e+16, 'ratio': 0.25},
+            {'seconds': 1e-05, 'ratio': 9.99e-05, 'share': 0.0001},
+            [True, False, [], {}],
+            {'at': datetime.datetime(2023, 1, 2, 3, 4, 5)},
+            {'rows': [self.Row(1, datetime.date(2023, 1, 2))]},
+            {'id': uuid.UUID(int=1), 'price': decimal.Decimal('1.50')},
+            # int keys deeper than the top level
+            {'counts': {'by_category': {9: 1, 10: 2}}},
+            {'pages': [{9: 'Art', 10: 'Science'}]},
+        ]
+        for value in values:
+            for arguments in [{'indent': 2}, {'separators': (',', ':')}]:
+                self.assertEqual(
+                    provider.dumps(value, **arguments),
+                    flask_provider.dumps(value, **arguments)
+                )
+
+    def test_category_ids_of_any_length(self):
+        provider = FastJSONProvider(app)
+        value = {'categories': {9: 'Art', 10: 'Science', 100: 'History'},
+                 'current_category': None, 'total_questions': 3}
+        for arguments in [{'indent': 2}, {'separators': (',', ':')}]:
+            with mock.patch.object(DefaultJSONProvider, 'dumps') as dumps:
+                data = provider.dumps(value, **arguments)
+            # encoded by orjson, in the numeric order of the ids
+            dumps.assert_not_called()
+            self.assertEqual(data, json.dumps(value, sort_keys=True,
+                                              **arguments))
+
+    def test_list_responses_unchanged(self):
+        client = app.test_client()
+        # indented in debug mode, which earlier tests may have changed
+        for debug, arguments in [(True, {'indent': 2}),
+                                 (False, {'separators': (',', ':')})]:
+            with mock.patch.dict(app.config, {'DEBUG': debug}):
+                for path in ['/questions?page=2', '/categories/1/questions',
+                             '/categories']:
+                    response = client.get(path)
+                    self.assertEqual(
+                        response.data.decode(),
+                        json.dumps(response.get_json(), sort_keys=True,
+                                   **arguments) + '\n'
+                    )
+
+
+class TestMigrations(TestCase):
+
+    def test_migrate_existing_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine(f'sqlite:///{directory}/trivia.db')
+            with engine.begin() as connection:
+                # tables created before the indexes were added
+                connection.exec_driver_sql(
+                    'CREATE TABLE categories (id INTEGER PRIMARY KEY, '
+                    'type VARCHAR)'
+                )
+                connection.exec_driver_sql(
+                    'CREATE TABLE questions (id INTEGER PRIMARY KEY, '
+                    'question VARCHAR, answer VARCHAR, difficulty INTEGER, '
+                    'category INTEGER REFERENCES categories (id))'
+                )
+                connection.exec_driver_sql(
+                    "INSERT INTO categories VALUES (1, 'Art')"
+                )
+                connection.exec_driver_sql(
+                    "INSERT INTO questions (category) VALUES (1), (1)"
+                )
+
+            self.assertEqual(migrate(engine),
+                             [version for version, _, _ in MIGRATIONS])
+            self.assertEqual(migrate(engine), [])
+            with engine.connect() as connection:
+                counts = connection.exec_driver_sql(
+                    'SELECT categories.question_count, '
+                    'question_bank_version.question_count '
+                    'FROM categories, question_bank_version'
+                ).one()
+                # the inspector leaves out expression indexes on SQLite
+                indexes = set(connection.exec_driver_sql(
+                    "SELECT name FROM sqlite_master WHERE type = 'index' "
+                    "AND name LIKE 'ix_%'"
+                ).scalars())
+            engine.dispose()
+        self.assertEqual(tuple(counts), (2, 2))
+        self.assertEqual(indexes, {
+            'ix_categories_type_lower',
+            'ix_questions_category',
+            'ix_questions_category_id',
+        })
+
+
+class TestQuizProgress(TestCase):
+
+    def test_wide_span(self):
+        ids = [1, 500000, MAX_SPAN]
+        progress = QuizProgress.loads(
+            QuizProgress.from_ids(0, ids).dumps('key'), 'key', 0
+        )
+        start = time.perf_counter()
+        self.assertEqual(list(progress), ids)
+        # linear in the span: a few milliseconds
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(len(progress), 3)
+
+        # one more id would span more than MAX_SPAN
+        progress.add(MAX_SPAN + 1)
+        self.assertTrue(progress.overflow)
+
+
+class TestSearchIndex(TestCase):
+
+    def setUp(self):
+        self.index = InvertedIndex()
+        self.index.build([
+            (1, 'Who painted the Mona Lisa?', 'Leonardo da Vinci'),
+            (2, 'Which painter cut off his ear?', 'Van Gogh'),
+            (3, 'What did Van Gogh paint?', 'Sunflowers, and more paint'),
+        ])
+
+    def test_match_ranked_by_relevance(self):
+        question_ids, total = self.index.match(['paint'], 0, 10)
+        self.assertEqual(total, 3)
+        self.assertEqual(question_ids[0], 3)
+
+    def test_match_all_tokens(self):
+        question_ids, total = self.index.match(['van', 'ear'], 0, 10)
+        self.assertEqual(question_ids, [2])
+
+    def test_discard(self):
+        self.index.discard(3)
+        question_ids, total = self.index.match(['gogh'], 0, 10)
+        self.assertEqual(question_ids, [2])
+
+
+class TestCategoryCache(TestCase):
+
+    class SharedBackend(dict):
+        def incr(self, key):
+            self[key] = self.get(key, 0) + 1
+
+    def test_shared_invalidation(self):
+        backend = self.SharedBackend()
+        worker_1 = CategoryCache(backend=backend)
+        worker_2 = CategoryCache(backend=backend)
+        worker_1.get(lambda: {1: 'Science'})
+        worker_2.get(lambda: {1: 'Science'})
+
+        worker_1.invalidate()
+        categories = worker_2.get(lambda: {1: 'Science', 2: 'Art'})
+        self.assertEqual(categories, {1: 'Science', 2: 'Art'})
+        self.assertEqual(worker_2.stats()['misses'], 2)
+
+    def test_data_version_backend_down(self):
+        backend = mock.Mock()
+        backend.get.side_effect = ConnectionError
+        backend.incr.side_effect = ConnectionError
+        version = DataVersion(backend=backend)
+        # never equal to a version read before
+        self.assertNotEqual(version.current(), version.current())
+        self.assertIsNone(version.bump())
+
+    def test_version(self):
+        cache = CategoryCache()
+        cache.get(lambda: {1: 'Science'}, 2)
+        self.assertEqual(cache.get(lambda: {1: 'Art'}, 1), {1: 'Science'})
+        self.assertEqual(cache.get(lambda: {1: 'Art'}, 3), {1: 'Art'})
+        self.assertEqual(cache.get(lambda: {1: 'History'}), {1: 'Art'})
+
+    def test_ttl(self):
+        cache = CategoryCache(ttl=0)
+        cache.get(lambda: {1: 'Science'})
+        cache.get(lambda: {1: 'Science'})
+        self.assertEqual(cache.stats()['hits'], 0)
+
+
+class TestBenchmarkData(TestCase):
+
+    def test_generate_questions(self):
+        questions = list(generate_questions(100, [1, 2], seed=1))
+        self.assertEqual(len(questions), 100)
+        self.assertEqual(questions, list(generate_questions(100, [1, 2], 1)))
+        self.assertTrue(all(q['category'] in (1, 2) for q in questions))
+        self.assertTrue(all(1 <= q['difficulty'] <= 5 for q in questions))
+
+    def test_measure_serialization(self):
+        with app.app_context():
+            result = measure_serialization(1)
+        self.assertEqual(set(result),
+                         {'orm_json', 'core_fast_json', 'cpu_ms_saved'})
+        self.assertGreaterEqual(result['orm_json']['cpu_ms'], 0)
+
+
+class TestAsyncTrivia(TestCase):
+    # The async entry point runs against a local SQLite/aiosqlite file
+
+    @classmethod
+    def setUpClass(cls):
+        search_engine.reset()
+        category_cache.invalidate()
+        cls.directory = tempfile.TemporaryDirectory()
+        uri = f'sqlite:///{cls.directory.name}/trivia.db'
+        engine = create_engine(uri)
+        db.metadata.create_all(engine)
+        migrate(engine)
+        with engine.begin() as connection:
+            connection.execute(db.insert(Category), [
+                {'id': 1, 'type': 'Science'},
+                {'id': 2, 'type': 'Art'},
+            ])
+            connection.execute(db.insert(Question), [
+                {
+                    'question': f'Question {i}',
+                    'answer': f'Answer {i}',
+                    'difficulty': 1,
+                    'category': 1 + i % 2,
+                }
+                for i in range(ITEMS_PER_PAGE + 5)
+            ])
+        engine.dispose()
+
+        config = type('AsyncTestConfig', (), {
+            'SQLALCHEMY_DATABASE_URI': uri,
+            'SECRET_KEY': 'async test',
+        })
+        cls.client = TestClient(create_asgi_app(config))
+        cls.client.__enter__()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.__exit__(None, None, None)
+        cls.directory.cleanup()
+        # drop what the caches of this process hold about the test file
+        search_engine.reset()
+        category_cache.invalidate()
+
+    def test_get_questions(self):
+        response = self.client.get('/questions', params={'page': 2})
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['actual_page'], 2)
+        self.assertEqual(len(data['questions']), 5)
+        self.assertEqual(data['total_questions'], ITEMS_PER_PAGE + 5)
+        self.assertEqual(data['categories'], {'1': 'Science', '2': 'Art'})
+
+    def test_get_questions_by_category(self):
+        response = self.client.get('/categories/2/questions')
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['current_category'], 'Art')
+        self.assertTrue(all(q['category'] == 2 for q in data['questions']))
+
+        response = self.client.get('/categories/1000/questions')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['success'], False)
+
+    def test_add_and_delete_question(self):
+        response = self.client.post('/questions',
+                                    json={
+                                      'question': 'async test',
+                                      'answer': 'test',
+                                      'difficulty': 1,
+                                      'category': 1,
+                                    })
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+
+        response = self.client.delete(f"/questions/{data['question_id']}")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'success': True})
+
+    def test_question_search(self):
+        response = self.client.post('/questions',
+                                    json={'search_term': 'answer 3'})
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['questions'][0]['answer'], 'Answer 3')
+
+    def test_get_quiz_question(self):
+        response = self.client.post('/quizzes',
+                                    json={
+                                      'quiz_category': {'id': 2},
+                                      'previous_questions': [2],
+                                    })
+        data = response.json()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['question']['category'], 2)
+        self.assertNotEqual(data['question']['id'], 2)
+
+        response = self.client.post('/quizzes',
+                                    json={
+                                      'quiz_category': {'id': 2},
+                                      'previous_questions': [1],
+                                    })
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_quiz_question_token(self):
+        asked = []
+        body = {'quiz_category': {'id': 2}, 'previous_questions': []}
+        for _ in range(ITEMS_PER_PAGE):
+            data = self.client.post('/quizzes', json=body).json()
+            if data['question'] is None:
+                break
+            asked.append(data['question']['id'])
+            body = {'quiz_category': {'id': 2},
+                    'quiz_token': data['quiz_token']}
+        self.assertEqual(len(asked), len(set(asked)))
+        self.assertEqual(len(asked), (ITEMS_PER_PAGE + 5) // 2)
+
+
 if __name__ == "__main__":
     unittest.main()
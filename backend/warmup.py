@@ -0,0 +1,187 @@
+import os
+import sys
+import time
+import weakref
+import threading
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+from models import db, Question
+from snapshot import question_snapshot
+
+# Requests dispatched by the warm-up: the question list (with the
+# category map and the question count), the categories, the quiz without
+# previous questions, a search and a suggestion (building the prefix
+# index). The quiz with previous questions is added with an existing
+# question, see quiz_request.
+WARMUP_REQUESTS = [
+    ('GET', '/questions', None),
+    ('GET', '/categories', None),
+    ('POST', '/quizzes', {'previous_questions': [],
+                          'quiz_category': {'id': 0}}),
+    ('POST', '/questions', {'search_term': 'the'}),
+    ('GET', '/questions/suggest?q=w', None),
+]
+
+
+# Worker warm-up
+# ---------------------------------------------------------------------
+# A cold worker opens its database connections, compiles its statements
+# and fills its caches on the first requests it serves. The warm-up does
+# that in a background thread before the worker is reported ready: it
+# opens the connections the pool keeps (pool_size), loads the question
+# snapshot when it is enabled, and dispatches WARMUP_REQUESTS to their
+# views, without the request hooks, so they aren't counted as traffic.
+#
+# It starts right after the worker is forked by a pre-forking server,
+# or otherwise on the first request the worker receives, typically the
+# readiness probe. A failed warm-up is retried on the next request.
+#
+# Each application has its own warm-up state, in app.extensions.
+class Warmup:
+
+    def __init__(self):
+        self.states = weakref.WeakSet()
+        self.fork_hook = False
+
+    def init_app(self, app):
+        if not self.fork_hook:
+            # registered once: forks run the hooks in registration order,
+            # so the pools of the child are reset before it starts here
+            os.register_at_fork(after_in_child=self.after_fork)
+            self.fork_hook = True
+        state = WarmupState(app)
+        app.extensions['warmup'] = state
+        self.states.add(state)
+        app.before_request(self.start)
+
+    def state(self, app=None):
+        return (app or current_app).extensions['warmup']
+
+    def is_ready(self, app=None):
+        return self.state(app).is_ready()
+
+    def after_fork(self):
+        for state in list(self.states):
+            state.reset()
+            if state.enabled():
+                state.start()
+
+    def start(self, app=None):
+        self.state(app).start()
+
+    def reset(self, app=None):
+        self.state(app).reset()
+
+    def stats(self, app=None):
+        return self.state(app).stats()
+
+
+class WarmupState:
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.thread = None
+        self.ready = threading.Event()
+        self.seconds = None
+        self.connections = 0
+        self.error = None
+        self.failed = []
+
+    def enabled(self):
+        return self.app.config.get('WARMUP', True)
+
+    def is_ready(self):
+        return not self.enabled() or self.ready.is_set()
+
+    def start(self):
+        if self.thread is not None or not self.enabled():
+            return
+        with self.lock:
+            if self.thread is not None or self.ready.is_set():
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            with self.app.app_context():
+                self.connections = self.open_connections(db.engine)
+                if question_snapshot.enabled():
+                    question_snapshot.get()
+                    question_snapshot.refresh()
+                requests = list(WARMUP_REQUESTS)
+                quiz = self.quiz_request()
+                if quiz is not None:
+                    requests.append(quiz)
+                self.failed = [
+                    f'{method} {path}'
+                    for method, path, body in requests
+                    if self.dispatch(method, path, body) >= 400
+                ]
+        except Exception:
+            print(sys.exc_info())
+            self.error = str(sys.exc_info()[1])
+            self.thread = None
+            return
+        self.seconds = time.perf_counter() - start
+        self.error = None
+        self.ready.set()
+
+    def open_connections(self, engine):
+        # pools without a size (NullPool) don't keep connections
+        size = getattr(engine.pool, 'size', None)
+        if size is None:
+            return 0
+        connections = []
+        try:
+            for _ in range(size()):
+                connections.append(engine.connect())
+        finally:
+            for connection in connections:
+                connection.close()
+        return len(connections)
+
+    # Quiz of the category of the first question, which was asked
+    # already: previous questions must exist in the category
+    def quiz_request(self):
+        row = db.session.execute(
+                db.select(Question.id, Question.category).where(
+                    Question.category.is_not(None)
+                ).order_by(Question.id).limit(1)
+              ).first()
+        if row is None:
+            return None
+        return ('POST', '/quizzes', {'previous_questions': [row.id],
+                                     'quiz_category': {'id': row.category}})
+
+    # Status code of the response
+    def dispatch(self, method, path, body):
+        with self.app.test_request_context(path, method=method, json=body):
+            try:
+                return self.app.make_response(
+                            self.app.dispatch_request()
+                       ).status_code
+            except HTTPException as e:
+                return e.code
+            finally:
+                db.session.rollback()
+
+    def stats(self):
+        return {
+            'enabled': bool(self.enabled()),
+            'ready': self.is_ready(),
+            'seconds': round(self.seconds, 6)
+            if self.seconds is not None else None,
+            'connections': self.connections,
+            'error': self.error,
+            'failed': self.failed,
+        }
+
+
+warmup = Warmup()
@@ -0,0 +1,14 @@
+from app import create_app
+
+# WSGI entry point
+# ---------------------------------------------------------------------
+# Builds the app once at import time. With a pre-forking server loading
+# the app before it forks its workers, e.g.:
+#
+#   gunicorn --preload --workers 4 wsgi:app
+#   uwsgi --http :5000 --module wsgi:app --master --processes 4
+#
+# modules, models and configuration are loaded once in the master
+# process, and the workers share that memory. Each worker opens its own
+# database connections after the fork.
+app = create_app('config.ProductionConfig')
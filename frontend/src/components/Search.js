@@ -1,8 +1,10 @@
 import React, { Component } from 'react';
+import $ from 'jquery';
 
 class Search extends Component {
   state = {
     query: '',
+    suggestions: [],
   };
 
   getInfo = (event) => {
@@ -16,6 +18,29 @@ class Search extends Component {
       this.setState({
         query: this.search.value,
       });
+      this.getSuggestions(this.search.value);
+  };
+
+  getSuggestions = (query) => {
+    if (query.trim().length === 0) {
+      this.setState({ suggestions: [] });
+      return;
+    }
+    $.ajax({
+      url: `/questions/suggest?q=${encodeURIComponent(query)}`,
+      type: 'GET',
+      success: (result) => {
+        // ignore the answer to an outdated query
+        if (query === this.state.query) {
+          this.setState({
+            suggestions: result.suggestions.map((s) => s.term),
+          });
+        }
+      },
+      error: () => {
+        this.setState({ suggestions: [] });
+      },
+    });
   };
 
   render() {
@@ -26,7 +51,14 @@ class Search extends Component {
           placeholder='Search questions...'
           ref={(input) => (this.search = input)}
           onChange={this.handleInputChange}
+          list='search-suggestions'
+          autoComplete='off'
         />
+        <datalist id='search-suggestions'>
+          {this.state.suggestions.map((term) => (
+            <option key={term} value={term} />
+          ))}
+        </datalist>
         <button type='submit' className='search-button'>
           <img
               className='search-icon'